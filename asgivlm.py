@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+# asyncio front end for webvlm, run with e.g. uvicorn asgivlm:app
+# elevation lookups go to a thread pool, smoothing and KML to a process pool
+# identical conversions in flight are computed once
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+import os
+import json
+import asyncio
+import concurrent.futures
+import vlm
+import webvlm
+from webvlm import metrics, resultcache, maxbody
+
+iopool = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.getenv('IOWORKERS', '64')))
+cpupool = None
+inflight = {}
+# a conversion taking longer is given up, so its inflight entry cannot outlive it
+computetimeout = float(os.getenv('COMPUTETIMEOUT', '300'))
+
+class BadRequest(Exception):
+    pass
+
+def render(conv):
+    conv.smooth()
+    return b''.join(conv.iterkml())
+
+def pool():
+    # created lazily so server workers fork before the CPU pool starts
+    global cpupool
+    if cpupool is None:
+        cpupool = concurrent.futures.ProcessPoolExecutor(max_workers=int(os.getenv('CPUWORKERS', '0')) or None)
+    return cpupool
+
+async def compute(key, csv, mission, *params):
+    loop = asyncio.get_event_loop()
+    conv = webvlm.newconvert(*params)
+    try:
+        await loop.run_in_executor(iopool, conv.readcsv, csv, mission)
+        del csv
+        elevation = conv.elevation
+        conv.elevation = conv.elevcache = conv.metrics = None
+        with metrics.stage('render'):
+            kml = await loop.run_in_executor(pool(), render, conv)
+    except (vlm.LimitError, vlm.ElevationError):
+        raise
+    except Exception as e:
+        raise BadRequest(str(e))
+    # results built on the zero elevation fallback are not worth keeping
+    if resultcache and not elevation.errors:
+        await loop.run_in_executor(iopool, lambda: list(resultcache.store(key, [kml])))
+    return kml
+
+async def convert(j, headers):
+    accept = parse_accept_header(headers.get('accept'), MIMEAccept)
+    resp, state = webvlm.negotiate(j, accept, parse_etags(headers.get('if-none-match')))
+    if resp is not None:
+        return resp
+    fmt, params, key, resp, cached = state
+    kml = None
+    if cached is None:
+        task = inflight.get(key)
+        if task is None:
+            task = inflight[key] = asyncio.ensure_future(asyncio.wait_for(compute(key, j.pop('0'), *params), computetimeout))
+            task.add_done_callback(lambda t: inflight.pop(key, None))
+        else:
+            metrics.inc('vlm_coalesced_total')
+        try:
+            kml = [await asyncio.shield(task)]
+        except BadRequest:
+            return webvlm.failure(400, 'Bad request data\n', fmt)
+        except vlm.LimitError:
+            return webvlm.failure(413, 'Mission too large\n', fmt)
+        except vlm.ElevationError:
+            return webvlm.failure(503, 'Elevation unavailable\n', fmt)
+        except asyncio.TimeoutError:
+            return webvlm.failure(504, 'Conversion timed out\n', fmt)
+    return webvlm.respond(state, kml, parse_accept_header(headers.get('accept-encoding')))
+
+async def readbody(receive):
+    body = []
+    size = 0
+    while True:
+        message = await receive()
+        body.append(message.get('body', b''))
+        size += len(body[-1])
+        if maxbody and size > maxbody:
+            raise vlm.LimitError('Request body over {0} bytes'.format(maxbody))
+        if not message.get('more_body'):
+            return b''.join(body)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if cpupool:
+                cpupool.shutdown()
+            iopool.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    headers = dict([(k.decode('latin-1').lower(), v.decode('latin-1')) for k, v in scope['headers']])
+    if scope['path'] == '/convert' and scope['method'] == 'POST':
+        try:
+            # announced oversized bodies are refused unread, the rest are cut off once they pass the limit
+            if maxbody and int(headers.get('content-length') or 0) > maxbody:
+                raise vlm.LimitError('Request body over {0} bytes'.format(maxbody))
+            j = json.loads((await readbody(receive)).decode('utf-8'))
+        except vlm.LimitError:
+            status, resp, body = webvlm.failure(413, 'Request too large\n')
+        except ValueError:
+            status, resp, body = await convert(None, headers)
+        else:
+            status, resp, body = await convert(j, headers)
+    elif scope['path'] in ('/healthz', '/metrics'):
+        text, status, resp = (webvlm.healthz if scope['path'] == '/healthz' else webvlm.prometheus)()
+        body = [text.encode('utf-8')]
+    else:
+        status, resp, body = webvlm.failure(404, 'Not found\n')
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in resp.items()]})
+    for chunk in body:
+        if chunk:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=os.getenv('HOST', '127.0.0.1'), port=int(os.getenv('PORT', '8000')))
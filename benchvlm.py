@@ -0,0 +1,450 @@
+#!/usr/bin/python3
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import platform
+import resource
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import threading
+import http.server
+import concurrent.futures
+import vlm
+
+KMLTYPE = 'application/vnd.google-earth.kml+xml'
+
+class FakeElevation(vlm.Elevation):
+    # deterministic terrain, keeps benchmarks off the network
+    def query(self, latlons):
+        return [100.0 + 50.0 * math.sin(math.radians(i[0] * 1000.0)) * math.cos(math.radians(i[1] * 1000.0)) for i in latlons]
+
+def gencsv(waypoints, curve=20.0, pois=5, actions=True, feet=False, seed=1):
+    r = random.Random(seed)
+    header = ['latitude', 'longitude', 'altitude(ft)' if feet else 'altitude(m)', 'heading(deg)', 'curvesize(m)', 'rotationdir', 'gimbalmode', 'gimbalpitchangle']
+    for i in range(1, 16):
+        header += ['actiontype{0}'.format(i), 'actionparam{0}'.format(i)]
+    header += ['altitudemode', 'speed(m/s)', 'poi_latitude', 'poi_longitude', 'poi_altitude(m)', 'poi_altitudemode', 'photo_timeinterval', 'photo_distinterval']
+    unit = 3.28084 if feet else 1.0
+    lat, lon = r.uniform(-60.0, 60.0), r.uniform(-180.0, 180.0)
+    poilist = [(lat + r.uniform(-0.01, 0.01), lon + r.uniform(-0.01, 0.01), r.uniform(0.0, 50.0) * unit) for i in range(0, pois)]
+    lines = [','.join(header)]
+    for n in range(0, waypoints):
+        lat += r.uniform(-0.002, 0.002)
+        lon += r.uniform(-0.002, 0.002)
+        row = [lat, lon, r.uniform(30.0, 120.0) * unit, r.uniform(0.0, 360.0), r.choice([0.0, curve, curve * 2.0]) * unit, 0, r.choice([0, 1, 2]), r.uniform(-90.0, 0.0)]
+        for a in range(0, 15):
+            row += [r.choice([-1, 1, 2, 5]), r.randint(0, 100)] if actions and a < 3 else [-1, 0]
+        row += [r.choice([0, 1]), r.choice([0, 5, 8])]
+        row += list(r.choice(poilist)) + [0] if poilist and r.random() < 0.5 else [0, 0, 0, 0]
+        row += [-1, -1]
+        lines.append(','.join([str(i) for i in row]))
+    return '\n'.join(lines) + '\n'
+
+def maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def stages(text, kw):
+    conv = vlm.Convert(elevation=FakeElevation(), **kw)
+    yield 'parsecsv', lambda: conv.parsecsv(io.StringIO(text), 'bench')
+    yield 'elevate', lambda: conv.elevate(conv.elevation.request(conv.latlons()))
+    yield 'smooth', conv.smooth
+    yield 'kml', lambda: sum([len(i) for i in conv.iterkml()])
+    yield 'kmz', lambda: sum([len(i) for i in conv.iterkmz()])
+
+def measure(text, kw, repeat=3, trace=True):
+    res = {}
+    for r in range(0, repeat):
+        for name, fn in stages(text, kw):
+            t = time.perf_counter()
+            fn()
+            dt = time.perf_counter() - t
+            st = res.setdefault(name, {'wall': []})
+            st['wall'].append(dt)
+    if trace:
+        # separate pass, tracing distorts timings, the process-wide RSS peak can't be split per stage
+        for name, fn in stages(text, kw):
+            tracemalloc.start()
+            fn()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            res[name]['alloc_peak'] = peak
+            res[name]['alloc_retained'] = current
+    for st in res.values():
+        st['wall_min'] = min(st['wall'])
+        st['wall_median'] = sorted(st['wall'])[len(st['wall']) // 2]
+    return res
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    kw = {'infilldist': args.interval, 'nbezier': args.bezier, 'fastgeo': args.fast_geo, 'tolerance': args.tolerance, 'simplify': args.simplify}
+    results = []
+    for n in args.waypoints:
+        text = gencsv(n, curve=args.curve, pois=args.pois, actions=not args.no_actions, feet=args.feet, seed=args.seed)
+        conv = vlm.Convert(elevation=FakeElevation(), **kw)
+        conv.readcsv(io.StringIO(text), 'bench')
+        conv.smooth()
+        res = {'waypoints': n, 'pois': len(conv.pois), 'smoothed': len(conv.smoothed), 'stages': measure(text, kw, args.repeat, not args.no_trace)}
+        results.append(res)
+        print('{0} waypoints, {1} smoothed points'.format(n, res['smoothed']))
+        for name, st in res['stages'].items():
+            print('  {0:10s} {1:9.4f}s  peak alloc {2:>12}'.format(name, st['wall_min'], st.get('alloc_peak', '-')))
+    doc = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'params': dict(kw, curve=args.curve, pois=args.pois, actions=not args.no_actions, feet=args.feet, seed=args.seed, repeat=args.repeat),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+    return 0
+
+def compare(args):
+    old, new = [json.load(open(i)) for i in (args.old, args.new)]
+    print('{0} -> {1}'.format(old.get('revision'), new.get('revision')))
+    worse = False
+    oldres = dict([(i['waypoints'], i) for i in old['results']])
+    for res in new['results']:
+        if res['waypoints'] not in oldres:
+            continue
+        print('{0} waypoints'.format(res['waypoints']))
+        for name, st in res['stages'].items():
+            ost = oldres[res['waypoints']]['stages'].get(name)
+            if not ost:
+                continue
+            ratio = st['wall_min'] / ost['wall_min'] if ost['wall_min'] else float('inf')
+            worse = worse or ratio > 1.0 + args.threshold
+            print('  {0:10s} {1:9.4f}s -> {2:9.4f}s  x{3:.2f}{4}'.format(name, ost['wall_min'], st['wall_min'], ratio, '  REGRESSION' if ratio > 1.0 + args.threshold else ''))
+    return int(worse)
+
+def generate(args):
+    text = gencsv(args.waypoints, curve=args.curve, pois=args.pois, actions=not args.no_actions, feet=args.feet, seed=args.seed)
+    with open(args.csvfile, 'w') as f:
+        f.write(text)
+    return 0
+
+class StubElevation(http.server.BaseHTTPRequestHandler):
+    # Open-Elevation lookalike with a fixed response delay plus random jitter,
+    # failures are error statuses answered to the next requests
+    delay = 0.0
+    jitter = 0.0
+    failures = []
+    requests = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        with self.lock:
+            StubElevation.requests += 1
+            status = StubElevation.failures.pop(0) if StubElevation.failures else 200
+        time.sleep(self.delay + random.uniform(0.0, self.jitter))
+        if status != 200:
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = json.dumps({'results': [{'elevation': round(i['latitude'] * 2.0, 3)} for i in body['locations']]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+def stub(delay):
+    StubElevation.delay = delay
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubElevation)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{0}/api/v1/lookup'.format(server.server_address[1])
+
+async def asgicall(app, payload):
+    sent = [{'type': 'http.request', 'body': payload}]
+    status = []
+    async def receive():
+        return sent.pop() if sent else {'type': 'http.disconnect'}
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+    scope = {'type': 'http', 'method': 'POST', 'path': '/convert', 'headers': [(b'accept', KMLTYPE.encode())]}
+    await app(scope, receive, send)
+    return status[0]
+
+def latency(name, wall, times, statuses, upstream):
+    times = sorted(times)
+    print('{0:6s} {1:3d} requests in {2:7.2f}s  {3:6.2f} req/s  p50 {4:6.2f}s  p95 {5:6.2f}s  upstream calls {6}  errors {7}'.format(
+        name, len(times), wall, len(times) / wall, times[len(times) // 2], times[int(len(times) * 0.95)], upstream, len([i for i in statuses if i != 200])))
+    return {'requests': len(times), 'wall': wall, 'rps': len(times) / wall, 'p50': times[len(times) // 2], 'p95': times[int(len(times) * 0.95)], 'upstream': upstream}
+
+def load(args):
+    # conversion servers read their configuration from the environment at import
+    server, url = stub(args.delay)
+    for k in ('GOOGLEKEY', 'DEMDIR', 'RESULTCACHE', 'ELEVCACHE'):
+        os.environ.pop(k, None)
+    os.environ['OPENAPIURL'] = url
+    os.environ['ELEVBATCH'] = str(args.batch_window)
+    import webvlm
+    import asgivlm
+    payloads = []
+    for i in range(0, args.requests):
+        seed = args.seed + i % (args.unique or args.requests)
+        text = gencsv(args.waypoints, curve=args.curve, pois=args.pois, actions=not args.no_actions, feet=args.feet, seed=seed)
+        payloads.append({'0': text, '1': 'bench{0}.csv'.format(seed)})
+    doc = {'revision': revision(), 'delay': args.delay, 'waypoints': args.waypoints, 'unique': args.unique, 'batch_window': args.batch_window}
+
+    # blocking Flask handler, one request per worker like the uWSGI deployment
+    webvlm.elevcache.mem.clear()
+    StubElevation.requests = 0
+    client = webvlm.app.test_client()
+    def syncone(payload):
+        t = time.perf_counter()
+        status = client.post('/convert', json=payload, headers={'Accept': KMLTYPE}).status_code
+        return time.perf_counter() - t, status
+    t = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.sync_workers) as pool:
+        res = list(pool.map(syncone, payloads))
+    doc['sync'] = latency('sync', time.perf_counter() - t, [i[0] for i in res], [i[1] for i in res], StubElevation.requests)
+
+    webvlm.elevcache.mem.clear()
+    StubElevation.requests = 0
+    async def asyncall():
+        limit = asyncio.Semaphore(args.concurrency)
+        async def one(payload):
+            async with limit:
+                t = time.perf_counter()
+                status = await asgicall(asgivlm.app, json.dumps(payload).encode('utf-8'))
+                return time.perf_counter() - t, status
+        return await asyncio.gather(*[one(i) for i in payloads])
+    asgivlm.pool().submit(int).result()
+    t = time.perf_counter()
+    res = asyncio.run(asyncall())
+    doc['async'] = latency('async', time.perf_counter() - t, [i[0] for i in res], [i[1] for i in res], StubElevation.requests)
+    server.shutdown()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+    return 0
+
+def requestrss(path, accept):
+    # runs in its own interpreter, the peak RSS of a process never goes down
+    import webvlm
+    client = webvlm.app.test_client()
+    warmup = {'0': gencsv(4), '1': 'warmup.csv'}
+    sum([len(i) for i in client.post('/convert', json=warmup, headers={'Accept': accept}).response])
+    with open(path, 'rb') as f:
+        body = f.read()
+    base = maxrss()
+    resp = client.post('/convert', data=body, content_type='application/json', headers={'Accept': accept})
+    size = sum([len(i) for i in resp.response])
+    print(json.dumps({'status': resp.status_code, 'base': base, 'peak': maxrss(), 'bytes': size}))
+
+def memory(args):
+    server, url = stub(0.0)
+    env = dict(os.environ, OPENAPIURL=url, ELEVBATCH='0')
+    for k in ('GOOGLEKEY', 'DEMDIR', 'RESULTCACHE', 'ELEVCACHE'):
+        env.pop(k, None)
+    if args.unlimited:
+        env.update(MAXBODY='0', MAXWAYPOINTS='0', MAXSMOOTHED='0')
+    accept = {'json': 'application/json', 'kml': KMLTYPE, 'kmz': 'application/vnd.google-earth.kmz'}[args.format]
+    doc = {'revision': revision(), 'format': args.format, 'interval': args.interval, 'unlimited': args.unlimited, 'sizes': {}}
+    code = 'import sys, benchvlm; benchvlm.requestrss(*sys.argv[1:])'
+    for n in args.waypoints:
+        text = gencsv(n, curve=args.curve, pois=args.pois, actions=not args.no_actions, feet=args.feet, seed=args.seed)
+        payload = {'0': text, '1': 'bench.csv', 'maxWPDist': args.interval}
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            f.write(json.dumps(payload).encode('utf-8'))
+            f.flush()
+            out = subprocess.check_output([sys.executable, '-c', code, f.name, accept], env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+            res = json.loads(out.decode().strip().split('\n')[-1])
+            res['body'] = os.path.getsize(f.name)
+        res['rss'] = res['peak'] - res['base']
+        doc['sizes'][str(n)] = res
+        print('{0:6d} waypoints  body {1:8.2f} MB  status {2}  peak RSS +{3:8.2f} MB  output {4:8.2f} MB'.format(
+            n, res['body'] / 1048576.0, res['status'], res['rss'] / 1024.0, res['bytes'] / 1048576.0))
+    server.shutdown()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+    return 0
+
+def golden(args):
+    # the streamed KML must stay byte-identical to the pykml tree writer
+    cases = [
+        ('metric', {}, {}, 'bench'),
+        ('feet', {'feet': True}, {}, 'bench'),
+        ('tnw', {}, {'headingmode': 0}, 'bench'),
+        ('markup', {}, {}, '<Mission> & "Zürich" \u2708'),
+        ]
+    failed = 0
+    for label, gen, kw, name in cases:
+        text = gencsv(args.waypoints, curve=args.curve, pois=args.pois, actions=not args.no_actions, seed=args.seed, **dict({'feet': args.feet}, **gen))
+        conv = vlm.Convert(elevation=FakeElevation(), infilldist=args.interval, **kw)
+        conv.readcsv(io.StringIO(text), name)
+        conv.smooth()
+        stream, tree = b''.join(conv.iterkml()), conv.getkml()
+        ok = stream == tree
+        failed += not ok
+        if ok:
+            print('{0:8s} OK    {1} bytes'.format(label, len(stream)))
+        else:
+            at = next((i for i in range(0, min(len(stream), len(tree))) if stream[i] != tree[i]), min(len(stream), len(tree)))
+            print('{0:8s} DIFF  at byte {1}: {2!r} != {3!r}'.format(label, at, stream[at:at+60], tree[at:at+60]))
+    return int(bool(failed))
+
+def geo(args):
+    # fast mode legs against geographiclib, up to the length solved on the tangent plane
+    r = random.Random(args.seed)
+    derr = aerr = 0.0
+    for i in range(0, args.legs):
+        lat, lon = r.uniform(-args.max_lat, args.max_lat), r.uniform(-180.0, 180.0)
+        s, azi = r.uniform(0.1, vlm.Geo.FASTLIMIT * 0.999), r.uniform(-180.0, 180.0)
+        g = vlm.Geo.WGS84.Direct(lat, lon, azi, s)
+        exact = vlm.Geo.inverse(lat, lon, g['lat2'], g['lon2'])
+        fast = vlm.Geo.inverse(lat, lon, g['lat2'], g['lon2'], True)
+        derr = max(derr, abs(fast[0] - exact[0]))
+        aerr = max(aerr, abs((fast[1] - exact[1] + 180.0) % 360.0 - 180.0))
+    print('{0} legs up to {1:.0f} m: max distance error {2:.2e} m (limit {3:.0e}), max azimuth error {4:.2e} deg (limit {5:.0e})'.format(
+        args.legs, vlm.Geo.FASTLIMIT, derr, args.distance, aerr, args.azimuth))
+    return int(derr > args.distance or aerr > args.azimuth)
+
+def elevation(args):
+    # HTTP provider against the stub: retried errors, chunks answered out of order, timeouts
+    server, url = stub(0.0)
+    StubElevation.jitter = args.jitter
+    latlons = [(10.0 + i * 0.01, 7.0) for i in range(0, args.points)]
+    chunks = (len(latlons) + vlm.Elevation.MAXPERREQ - 1) // vlm.Elevation.MAXPERREQ
+    # fewer failures than attempts per chunk, every chunk must still succeed
+    StubElevation.requests = 0
+    StubElevation.failures = ([503, 429] * args.retries)[:args.retries]
+    e = vlm.Elevation(openapi=url, workers=args.workers, retries=args.retries, backoff=0.01)
+    ordered = e.request(latlons) == [round(i[0] * 2.0, 3) for i in latlons]
+    retried = StubElevation.requests == chunks + args.retries and not e.errors
+    print('{0} points in {1} chunks, {2} workers: {3} requests, {4} fallbacks, {5}'.format(
+        len(latlons), chunks, args.workers, StubElevation.requests, e.errors, 'in order' if ordered else 'OUT OF ORDER'))
+    # a timed out request falls back to zero without retrying
+    StubElevation.requests = 0
+    StubElevation.failures = []
+    StubElevation.delay, StubElevation.jitter = args.timeout * 4.0, 0.0
+    e = vlm.Elevation(openapi=url, workers=1, retries=args.retries, backoff=0.01, timeout=args.timeout)
+    fallback = e.request(latlons[:10]) == [0] * 10 and e.errors == 1
+    print('timeout after {0:.2f}s: {1} requests, {2} fallbacks'.format(args.timeout, StubElevation.requests, e.errors))
+    server.shutdown()
+    return int(not (ordered and retried and fallback and StubElevation.requests == 1))
+
+def importcost(code, repeat):
+    best = None
+    for i in range(0, repeat):
+        t = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    return best
+
+def imports(args):
+    # fails when importing vlm costs more than the budget or loads a lazily imported dependency
+    base = importcost('pass', args.repeat)
+    cost = importcost('import vlm', args.repeat) - base
+    code = 'import sys; before = set(sys.modules); import vlm; print(" ".join(sorted(set(sys.modules) - before)))'
+    loaded = subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__))).decode().split()
+    eager = sorted(set([i.split('.')[0] for i in loaded]) & set(args.lazy))
+    print('import vlm: {0:.1f} ms over a bare interpreter, budget {1:.1f} ms'.format(cost * 1000.0, args.budget))
+    if eager:
+        print('loaded at import: ' + ' '.join(eager))
+    return int(cost * 1000.0 > args.budget or bool(eager))
+
+def missionargs(parser):
+    parser.add_argument('-c', '--curve', help='Curve size in meters', type=float, default=20.0)
+    parser.add_argument('-p', '--pois', help='Number of POIs', type=int, default=5)
+    parser.add_argument('--no-actions', help='Leave action columns empty', action='store_true')
+    parser.add_argument('--feet', help='Use altitude(ft) header', action='store_true')
+    parser.add_argument('--seed', help='Random seed', type=int, default=1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=vlm.MyHelpFormatter)
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('run', help='Time Convert stages on synthetic missions', formatter_class=vlm.MyHelpFormatter)
+    p.add_argument('-n', '--waypoints', help='Comma separated waypoint counts', type=lambda v: [int(i) for i in v.split(',')], default=[10, 99, 1000])
+    p.add_argument('-r', '--repeat', help='Repetitions per stage', type=int, default=3)
+    p.add_argument('-i', '--interval', help='Infill interval in meters', type=float, default=1000.0)
+    p.add_argument('-b', '--bezier', help='Number of bezier points per curve', type=int, default=5)
+    p.add_argument('--fast-geo', help='Use local tangent plane approximation', action='store_true')
+    p.add_argument('-a', '--tolerance', help='Adaptive sampling chord error in meters', type=float, default=None)
+    p.add_argument('--simplify', help='Douglas-Peucker simplification distance in meters', type=float, default=None)
+    p.add_argument('--no-trace', help='Skip tracemalloc allocation pass', action='store_true')
+    p.add_argument('-o', '--output', help='Write JSON results to this file', default=None)
+    missionargs(p)
+    p.set_defaults(func=run)
+    p = sub.add_parser('compare', help='Compare two JSON result files', formatter_class=vlm.MyHelpFormatter)
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('-t', '--threshold', help='Relative slowdown reported as regression', type=float, default=0.1)
+    p.set_defaults(func=compare)
+    p = sub.add_parser('load', help='Compare Flask and ASGI throughput against a slow stub elevation server', formatter_class=vlm.MyHelpFormatter)
+    p.add_argument('-n', '--waypoints', help='Waypoints per mission', type=int, default=50)
+    p.add_argument('-r', '--requests', help='Number of requests', type=int, default=32)
+    p.add_argument('-u', '--unique', help='Number of distinct missions, 0 for all distinct', type=int, default=0)
+    p.add_argument('-C', '--concurrency', help='Concurrent ASGI requests', type=int, default=32)
+    p.add_argument('-s', '--sync-workers', help='Concurrent Flask workers', type=int, default=4)
+    p.add_argument('-D', '--delay', help='Stub elevation response delay in seconds', type=float, default=1.0)
+    p.add_argument('-W', '--batch-window', help='Elevation batching window in seconds, 0 disables', type=float, default=0.0)
+    p.add_argument('-o', '--output', help='Write JSON results to this file', default=None)
+    missionargs(p)
+    p.set_defaults(func=load)
+    p = sub.add_parser('memory', help='Peak RSS of single webvlm requests at different mission sizes', formatter_class=vlm.MyHelpFormatter)
+    p.add_argument('-n', '--waypoints', help='Comma separated waypoint counts', type=lambda v: [int(i) for i in v.split(',')], default=[100, 1000, 10000])
+    p.add_argument('-i', '--interval', help='Infill interval in meters sent as maxWPDist', type=float, default=10.0)
+    p.add_argument('-f', '--format', help='Response format', choices=['json', 'kml', 'kmz'], default='json')
+    p.add_argument('--unlimited', help='Disable the body, waypoint and smoothed point limits', action='store_true')
+    p.add_argument('-o', '--output', help='Write JSON results to this file', default=None)
+    missionargs(p)
+    p.set_defaults(func=memory)
+    p = sub.add_parser('golden', help='Check streamed KML against the pykml tree writer', formatter_class=vlm.MyHelpFormatter)
+    p.add_argument('-n', '--waypoints', help='Waypoints per mission', type=int, default=50)
+    p.add_argument('-i', '--interval', help='Infill interval in meters', type=float, default=100.0)
+    missionargs(p)
+    p.set_defaults(func=golden)
+    p = sub.add_parser('geo', help='Check the fast geometry mode against geographiclib', formatter_class=vlm.MyHelpFormatter)
+    p.add_argument('-n', '--legs', help='Number of random legs', type=int, default=20000)
+    p.add_argument('--max-lat', help='Highest absolute latitude of the legs', type=float, default=80.0)
+    p.add_argument('-d', '--distance', help='Allowed distance error in meters', type=float, default=1e-3)
+    p.add_argument('-a', '--azimuth', help='Allowed azimuth error in degrees', type=float, default=1e-4)
+    p.add_argument('--seed', help='Random seed', type=int, default=1)
+    p.set_defaults(func=geo)
+    p = sub.add_parser('elevation', help='Check retries, chunk order and timeouts of the HTTP elevation provider', formatter_class=vlm.MyHelpFormatter)
+    p.add_argument('-n', '--points', help='Number of points looked up', type=int, default=1000)
+    p.add_argument('-w', '--workers', help='Concurrent upstream requests', type=int, default=4)
+    p.add_argument('-r', '--retries', help='Retries per request, also the number of 503/429 answers injected', type=int, default=3)
+    p.add_argument('-j', '--jitter', help='Random extra stub delay in seconds, shuffles chunk completion', type=float, default=0.05)
+    p.add_argument('-t', '--timeout', help='Request timeout in seconds for the timeout check', type=float, default=0.25)
+    p.set_defaults(func=elevation)
+    p = sub.add_parser('imports', help='Check the import time budget of vlm', formatter_class=vlm.MyHelpFormatter)
+    p.add_argument('-b', '--budget', help='Allowed import time in milliseconds', type=float, default=75.0)
+    p.add_argument('-r', '--repeat', help='Interpreter starts per measurement, the fastest counts', type=int, default=10)
+    p.add_argument('--lazy', help='Comma separated modules that must not load with vlm', type=lambda v: v.split(','), default=['requests', 'urllib3', 'simplejson', 'pykml', 'lxml', 'sqlite3', 'zipfile', 'xml'])
+    p.set_defaults(func=imports)
+    p = sub.add_parser('gen', help='Write a synthetic Litchi CSV mission', formatter_class=vlm.MyHelpFormatter)
+    p.add_argument('waypoints', type=int)
+    p.add_argument('csvfile')
+    missionargs(p)
+    p.set_defaults(func=generate)
+    args = parser.parse_args()
+    if not args.command:
+        parser.error('command is required')
+    sys.exit(args.func(args))
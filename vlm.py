@@ -1,52 +1,562 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
-from __future__ import division
 import csv
+import io
 import os
+import sys
 import math
-import copy
+import array
+import mmap
+import struct
+import time
+import random
+import threading
+import glob
+import itertools
+import functools
+import contextlib
+import collections
+import concurrent.futures
 import argparse
-import requests
-import simplejson
 import logging
 from geographiclib.geodesic import Geodesic
-from pykml.factory import KML_ElementMaker as KML
-from pykml.factory import GX_ElementMaker as GX
-from lxml import etree
+
+class ElevationCache(object):
+    # the row count is a full table scan, puts track an estimate and only count again
+    # when it passes maxsize or every RECOUNT puts, to see rows other processes added
+    RECOUNT = 1000
+    LOWWATER = 0.9
+
+    def __init__(self, path=None, grid=0.00001, ttl=0, maxsize=1000000, memsize=100000):
+        self.path = path
+        self.grid = grid
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.memsize = memsize
+        self.hits = 0
+        self.misses = 0
+        self.mem = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        self.pid = None
+        self.rows = 0
+        self.puts = 0
+
+    def key(self, latlon):
+        return (int(round(latlon[0] / self.grid)), int(round(latlon[1] / self.grid)))
+
+    def connect(self):
+        # sqlite handles must not cross fork(), so every process opens its own
+        if self.path and self.pid != os.getpid():
+            import sqlite3
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS elevation (grid REAL, lat INTEGER, lon INTEGER, elevation REAL, ts REAL, PRIMARY KEY (grid, lat, lon))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS elevation_ts ON elevation (ts)')
+            self.db.commit()
+            self.rows = self.db.execute('SELECT COUNT(*) FROM elevation').fetchone()[0]
+            self.pid = os.getpid()
+        return self.db
+
+    def expired(self, ts, now):
+        return self.ttl and ts < now - self.ttl
+
+    def memput(self, k, e, ts):
+        self.mem[k] = (e, ts)
+        self.mem.move_to_end(k)
+        while len(self.mem) > self.memsize:
+            self.mem.popitem(last=False)
+
+    def get(self, latlons):
+        now = time.time()
+        res = []
+        with self.lock:
+            db = self.connect()
+            for latlon in latlons:
+                k = self.key(latlon)
+                v = self.mem.get(k)
+                if v is not None and not self.expired(v[1], now):
+                    self.mem.move_to_end(k)
+                    res.append(v[0])
+                    continue
+                if db:
+                    v = db.execute('SELECT elevation, ts FROM elevation WHERE grid=? AND lat=? AND lon=?', (self.grid,) + k).fetchone()
+                if v is not None and not self.expired(v[1], now):
+                    self.memput(k, v[0], v[1])
+                    res.append(v[0])
+                else:
+                    res.append(None)
+            found = len([i for i in res if i is not None])
+            self.hits += found
+            self.misses += len(res) - found
+        return res
+
+    def put(self, latlons, elevations):
+        now = time.time()
+        with self.lock:
+            for latlon, e in zip(latlons, elevations):
+                self.memput(self.key(latlon), e, now)
+            db = self.connect()
+            if not db:
+                return
+            with db:
+                db.executemany('INSERT OR REPLACE INTO elevation VALUES (?, ?, ?, ?, ?)', [(self.grid,) + self.key(latlon) + (e, now) for latlon, e in zip(latlons, elevations)])
+                # replaced rows are counted too, the estimate errs on the high side
+                self.rows += len(latlons)
+                if self.ttl:
+                    self.rows -= db.execute('DELETE FROM elevation WHERE ts < ?', (now - self.ttl,)).rowcount
+                self.puts += 1
+                if self.rows > self.maxsize or self.puts % self.RECOUNT == 0:
+                    self.rows = db.execute('SELECT COUNT(*) FROM elevation').fetchone()[0]
+                if self.rows > self.maxsize:
+                    # evicting below the limit keeps the next puts from counting again
+                    extra = self.rows - int(self.maxsize * self.LOWWATER)
+                    db.execute('DELETE FROM elevation WHERE rowid IN (SELECT rowid FROM elevation ORDER BY ts LIMIT ?)', (extra,))
+                    self.rows -= extra
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'memsize': len(self.mem)}
+
+class ElevationError(Exception):
+    pass
+
+class LimitError(ValueError):
+    pass
+
+class RateLimit(object):
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.OrderedDict()
+        self.summaries = collections.OrderedDict()
+
+    @staticmethod
+    def labels(kv):
+        return tuple(sorted(kv.items()))
+
+    def inc(self, name, value=1, **kv):
+        with self.lock:
+            c = self.counters.setdefault(name, collections.OrderedDict())
+            c[self.labels(kv)] = c.get(self.labels(kv), 0) + value
+
+    def observe(self, name, value, **kv):
+        with self.lock:
+            s = self.summaries.setdefault(name, collections.OrderedDict()).setdefault(self.labels(kv), [0, 0.0, 0.0])
+            s[0] += 1
+            s[1] += value
+            s[2] = max(s[2], value)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.observe('vlm_stage_seconds', time.time() - t, stage=name)
+
+    def timed(self, chunks, name):
+        # only the time spent producing chunks counts, not the consumer
+        spent, size = 0.0, 0
+        try:
+            chunks = iter(chunks)
+            while True:
+                t = time.time()
+                try:
+                    chunk = next(chunks)
+                finally:
+                    spent += time.time() - t
+                size += len(chunk)
+                yield chunk
+        except StopIteration:
+            pass
+        finally:
+            self.observe('vlm_stage_seconds', spent, stage=name)
+            self.inc('vlm_payload_bytes_total', size, format=name)
+
+    @staticmethod
+    def labeltext(labels):
+        return '{' + ','.join(['{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels]) + '}' if labels else ''
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for name, c in self.counters.items():
+                lines.append('# TYPE {0} counter'.format(name))
+                lines += ['{0}{1} {2}'.format(name, self.labeltext(k), v) for k, v in c.items()]
+            for name, s in self.summaries.items():
+                lines.append('# TYPE {0} summary'.format(name))
+                for k, v in s.items():
+                    lines += ['{0}_count{1} {2}'.format(name, self.labeltext(k), v[0]), '{0}_sum{1} {2}'.format(name, self.labeltext(k), v[1])]
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        lines = []
+        with self.lock:
+            for name, s in self.summaries.items():
+                for k, v in s.items():
+                    lines.append('{0:50s} {1:6d} calls {2:10.4f}s total {3:10.4f}s max'.format(name + self.labeltext(k), v[0], v[1], v[2]))
+            for name, c in self.counters.items():
+                for k, v in c.items():
+                    lines.append('{0:50s} {1}'.format(name + self.labeltext(k), v))
+        return '\n'.join(lines) + '\n'
+
+def staged(name):
+    # times a Convert stage when the converter has metrics attached
+    def wrap(fn):
+        @functools.wraps(fn)
+        def run(self, *kc, **kv):
+            if not self.metrics:
+                return fn(self, *kc, **kv)
+            with self.metrics.stage(name):
+                return fn(self, *kc, **kv)
+        return run
+    return wrap
+
+class DemTiles(object):
+    VOID = -32768
+    PAIR = struct.Struct('>2h')
+
+    def __init__(self, path, maxtiles=16):
+        self.path = path
+        self.maxtiles = maxtiles
+        self.tiles = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tilename(lat, lon):
+        return '{0}{1:02d}{2}{3:03d}.hgt'.format('N' if lat >= 0 else 'S', abs(lat), 'E' if lon >= 0 else 'W', abs(lon))
+
+    def tile(self, lat, lon):
+        if (lat, lon) in self.tiles:
+            self.tiles.move_to_end((lat, lon))
+            return self.tiles[(lat, lon)]
+        name = os.path.join(self.path, self.tilename(lat, lon))
+        try:
+            with open(name, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            raise ElevationError('Missing DEM tile {0}'.format(name))
+        n = int(round(math.sqrt(len(mm) // 2)))
+        if n < 2 or n * n * 2 != len(mm):
+            mm.close()
+            raise ElevationError('Bad DEM tile {0}'.format(name))
+        self.tiles[(lat, lon)] = (mm, n)
+        while len(self.tiles) > self.maxtiles:
+            self.tiles.popitem(last=False)[1][0].close()
+        return mm, n
+
+    def edgetile(self, lat, lon):
+        # points on a tile border are sampled by the tiles on both sides, take one that is there
+        lat0, lon0 = int(math.floor(lat)), int(math.floor(lon))
+        err = None
+        for t in [(a, b) for a in ((lat0, lat0 - 1) if lat == lat0 else (lat0,)) for b in ((lon0, lon0 - 1) if lon == lon0 else (lon0,))]:
+            try:
+                self.tile(*t)
+                return t
+            except ElevationError as e:
+                err = err or e
+        raise err
+
+    def lookup(self, latlons):
+        res = [0.0]*len(latlons)
+        bytile = collections.defaultdict(list)
+        with self.lock:
+            for i in range(0, len(latlons)):
+                t = (int(math.floor(latlons[i][0])), int(math.floor(latlons[i][1])))
+                if latlons[i][0] == t[0] or latlons[i][1] == t[1]:
+                    t = self.edgetile(latlons[i][0], latlons[i][1])
+                bytile[t].append(i)
+            for (lat0, lon0), idx in bytile.items():
+                mm, n = self.tile(lat0, lon0)
+                for i in idx:
+                    # rows go north to south, samples are shared with neighbouring tiles
+                    y = (lat0 + 1 - latlons[i][0]) * (n - 1)
+                    x = (latlons[i][1] - lon0) * (n - 1)
+                    r, c = min(int(y), n - 2), min(int(x), n - 2)
+                    fy, fx = y - r, x - c
+                    h = self.PAIR.unpack_from(mm, 2 * (r * n + c)) + self.PAIR.unpack_from(mm, 2 * ((r + 1) * n + c))
+                    w = ((1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy)
+                    valid = [k for k in range(0, 4) if h[k] != self.VOID]
+                    wsum = sum([w[k] for k in valid])
+                    if wsum > 0:
+                        res[i] = sum([w[k] * h[k] for k in valid]) / wsum
+                    elif valid:
+                        res[i] = float(sum([h[k] for k in valid])) / len(valid)
+        return res
 
 class Elevation(object):
     GOOGLEAPI = 'https://maps.googleapis.com/maps/api/elevation/json'
     OPENAPI = 'https://api.open-elevation.com/api/v1/lookup'
     MAXPERREQ = 100
+    RATES = { GOOGLEAPI: 50.0 }
+    TIMEOUTS = { GOOGLEAPI: 30.0 }
+    sessions = {}
+    ratelimits = {}
+    poollock = threading.Lock()
 
-    def __init__(self, key='', openapi=''):
+    def __init__(self, key='', openapi='', cache=None, workers=4, retries=3, backoff=0.5, rate=None, dem=None, metrics=None, batcher=None, timeout=None):
         self.key = key
+        self.batcher = batcher
+        self.metrics = metrics
+        self.dem = dem
         self.openapi = openapi or self.OPENAPI
+        self.url = self.GOOGLEAPI if self.key else self.openapi
+        self.cache = cache
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.rate = self.RATES.get(self.url, 0.0) if rate is None else rate
+        self.timeout = self.TIMEOUTS.get(self.url, 120.0) if timeout is None else timeout
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def session(cls):
+        # connection pools are per process, uwsgi workers fork after import
+        pid = os.getpid()
+        with cls.poollock:
+            if pid not in cls.sessions:
+                import requests
+                s = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                s.mount('https://', adapter)
+                s.mount('http://', adapter)
+                cls.sessions = { pid: s }
+            return cls.sessions[pid]
+
+    def ratelimit(self):
+        with self.poollock:
+            return self.ratelimits.setdefault(self.url, RateLimit(self.rate))
+
+    def query(self, latlons):
+        import requests
+        for attempt in range(0, self.retries + 1):
+            if attempt and self.metrics:
+                self.metrics.inc('vlm_elevation_retries_total', provider=self.provider())
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            self.ratelimit().wait()
+            try:
+                if self.key:
+                    data = { 'locations': '|'.join(['{0},{1}'.format(*i[:2]) for i in latlons]), 'key': self.key }
+                    r = self.session().get(self.url, params=data, timeout=self.timeout)
+                else:
+                    data = { 'locations': [ {'latitude': i[0], 'longitude': i[1]} for i in latlons ] }
+                    r = self.session().post(self.url, json=data, timeout=self.timeout)
+                if r.status_code == 429 or r.status_code >= 500:
+                    continue
+                j = r.json()
+                e = [float(i.get('elevation', 0)) for i in j['results']]
+                assert len(e) == len(latlons)
+                return e
+            except requests.exceptions.Timeout:
+                # a timed out request already held the worker for the whole timeout
+                break
+            except requests.exceptions.RequestException:
+                continue
+            except (KeyError, TypeError, ValueError, AssertionError):
+                break
+        raise ElevationError('Elevation API error')
+
+    def provider(self):
+        return 'dem' if self.dem else 'google' if self.key else 'open'
 
     def singlerequest(self, latlons):
+        t = time.time()
         try:
-            if self.key:
-                data = { 'locations': '|'.join(['{0},{1}'.format(*i[:2]) for i in latlons]), 'key': self.key }
-                r = requests.get(self.GOOGLEAPI, data, timeout=30)
-            else:
-                data = { 'locations': [ {'latitude': i[0], 'longitude': i[1]} for i in latlons ] }
-                r = requests.post(self.openapi, json=data, timeout=120)
-            j = r.json()
-            e = [float(i.get('elevation', 0)) for i in j['results']]
-            assert len(e) == len(latlons)
-        except (requests.exceptions.Timeout, simplejson.errors.JSONDecodeError, KeyError, TypeError, ValueError, AssertionError):
+            e = self.batcher.query(latlons) if self.batcher else self.query(latlons)
+        except ElevationError:
             logging.error('Elevation API error, assuming zero ground elevation')
+            with self.lock:
+                self.errors += 1
+            if self.metrics:
+                self.metrics.inc('vlm_elevation_fallbacks_total', provider=self.provider())
+                self.metrics.inc('vlm_elevation_fallback_points_total', len(latlons), provider=self.provider())
             return [0]*len(latlons)
+        finally:
+            if self.metrics:
+                self.metrics.observe('vlm_elevation_request_seconds', time.time() - t, provider=self.provider())
+                self.metrics.inc('vlm_elevation_points_total', len(latlons), provider=self.provider())
+        if self.cache:
+            self.cache.put(latlons, e)
         return e
 
     def request(self, latlons):
+        if self.dem:
+            if self.metrics:
+                self.metrics.inc('vlm_elevation_points_total', len(latlons), provider=self.provider())
+            return self.dem.lookup(latlons)
+        if not self.cache:
+            return self.fetch(latlons)
+        res = self.cache.get(latlons)
+        missing = collections.OrderedDict()
+        for i in range(0, len(latlons)):
+            if res[i] is None:
+                missing.setdefault(self.cache.key(latlons[i]), []).append(i)
+        fetched = self.fetch([latlons[i[0]] for i in missing.values()])
+        for idx, e in zip(missing.values(), fetched):
+            for i in idx:
+                res[i] = e
+        return res
+
+    def fetch(self, latlons):
+        if self.batcher:
+            return self.singlerequest(latlons) if latlons else []
+        chunks = [latlons[k:k+self.MAXPERREQ] for k in range(0, len(latlons), self.MAXPERREQ)]
+        if self.workers > 1 and len(chunks) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.workers, len(chunks))) as pool:
+                results = list(pool.map(self.singlerequest, chunks))
+        else:
+            results = [self.singlerequest(i) for i in chunks]
+        return [e for i in results for e in i]
+
+class ElevationBatcher(object):
+    # merges lookups of concurrent conversions into shared upstream requests
+    def __init__(self, upstream, window=0.02, metrics=None, timeout=300.0):
+        self.upstream = upstream
+        self.window = window
+        self.metrics = metrics
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.pending = collections.OrderedDict()
+        # lookups already sent upstream, shared until their answer arrives
+        self.inflight = {}
+        self.pid = None
+
+    def start(self):
+        # the worker thread does not survive fork(), uwsgi workers fork after import
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pending = collections.OrderedDict()
+            self.inflight = {}
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def query(self, latlons):
+        futures = []
+        with self.cond:
+            self.start()
+            for latlon in latlons:
+                k = tuple(latlon[:2])
+                if k in self.inflight:
+                    futures.append(self.inflight[k])
+                    continue
+                if k not in self.pending:
+                    self.pending[k] = concurrent.futures.Future()
+                futures.append(self.pending[k])
+            self.cond.notify()
+        deadline = time.time() + self.timeout
+        try:
+            return [f.result(max(0.0, deadline - time.time())) for f in futures]
+        except concurrent.futures.TimeoutError:
+            raise ElevationError('Elevation batch timed out')
+
+    def run(self):
+        n = self.upstream.MAXPERREQ
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.upstream.workers)
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                deadline = time.time() + self.window
+                while len(self.pending) < n and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                batch = list(self.pending.items())
+                self.inflight.update(self.pending)
+                self.pending = collections.OrderedDict()
+            for k in range(0, len(batch), n):
+                pool.submit(self.send, batch[k:k+n])
+
+    def send(self, batch):
+        if self.metrics:
+            self.metrics.inc('vlm_elevation_batches_total', provider=self.upstream.provider())
+            self.metrics.observe('vlm_elevation_batch_points', len(batch), provider=self.upstream.provider())
+        # every waiting lookup gets an answer, whatever goes wrong upstream
+        try:
+            e = self.upstream.query([i[0] for i in batch])
+            for (k, f), v in zip(batch, e):
+                f.set_result(v)
+        except Exception as err:
+            if not isinstance(err, ElevationError):
+                err = ElevationError('Elevation API error: {0!r}'.format(err))
+            for k, f in batch:
+                if not f.done():
+                    f.set_exception(err)
+        finally:
+            with self.cond:
+                for k, f in batch:
+                    if self.inflight.get(k) is f:
+                        del self.inflight[k]
+
+class Geo(object):
+    WGS84 = Geodesic.WGS84
+    E2 = Geodesic.WGS84.f * (2.0 - Geodesic.WGS84.f)
+    # longest leg solved on the local tangent plane in fast mode
+    FASTLIMIT = 1000.0
+
+    @classmethod
+    def inverse(cls, lat1, lon1, lat2, lon2, fast=False):
+        if fast:
+            phi = math.radians((lat1 + lat2) / 2.0)
+            dlon = math.radians((lon2 - lon1 + 540.0) % 360.0 - 180.0)
+            w = 1.0 - cls.E2 * math.sin(phi)**2
+            dn = math.radians(lat2 - lat1) * cls.WGS84.a * (1.0 - cls.E2) / w**1.5
+            de = dlon * cls.WGS84.a / math.sqrt(w) * math.cos(phi)
+            s = math.sqrt(dn**2 + de**2)
+            if s < cls.FASTLIMIT:
+                # mid-leg azimuth, moved back to the start by half the meridian convergence
+                return s, math.degrees(math.atan2(de, dn) - dlon * math.sin(phi) / 2.0)
+        g = cls.WGS84.Inverse(lat1, lon1, lat2, lon2, Geodesic.DISTANCE | Geodesic.AZIMUTH)
+        return g['s12'], g['azi1']
+
+    @classmethod
+    def legs(cls, src, dst, fast=False):
+        # src and dst are (lat, lon, alt) sequences, a single dst tuple is used for every src
+        if dst and not isinstance(dst[0], (tuple, list)):
+            dst = [dst]*len(src)
         res = []
-        for k in range(0, (len(latlons)+self.MAXPERREQ-1)//self.MAXPERREQ):
-            res += self.singlerequest(latlons[k*self.MAXPERREQ:k*self.MAXPERREQ+self.MAXPERREQ])
+        for a, b in zip(src, dst):
+            s, azi = cls.inverse(a[0], a[1], b[0], b[1], fast)
+            res.append((s, azi, math.sqrt(s**2 + (a[2] - b[2])**2)))
         return res
 
+    @classmethod
+    def local(cls, origin, p):
+        # east, north, up offset in meters on the tangent plane at origin
+        phi = math.radians(origin[0])
+        w = 1.0 - cls.E2 * math.sin(phi)**2
+        return (math.radians((p[1] - origin[1] + 540.0) % 360.0 - 180.0) * cls.WGS84.a / math.sqrt(w) * math.cos(phi),
+                math.radians(p[0] - origin[0]) * cls.WGS84.a * (1.0 - cls.E2) / w**1.5,
+                p[2] - origin[2])
+
+    @classmethod
+    def chorderror(cls, a, b):
+        # distance between the lat/lon midpoint and the geodesic midpoint of a leg
+        line = cls.WGS84.InverseLine(a[0], a[1], b[0], b[1])
+        g = line.Position(line.s13 / 2.0)
+        e, n, u = cls.local((g['lat2'], g['lon2'], 0.0), ((a[0] + b[0]) / 2.0, (a[1] + b[1]) / 2.0, 0.0))
+        return math.sqrt(e**2 + n**2)
+
+    @staticmethod
+    def tilt(src, dst, d3):
+        return math.degrees(math.asin( (dst[2] - src[2]) / d3 )) + 90.0 if d3 else 90.0
+
 class Point(object):
     attrs = ['Latitude', 'Longitude', 'Altitude', 'AltMode', 'GroundAlt']
+    __slots__ = attrs
     def __init__(self, **kv):
         for i in self.attrs:
             if i in kv.keys():
@@ -59,7 +569,7 @@ class Point(object):
         return self(Latitude = k[0], Longitude = k[1], Altitude = k[2], AltMode = k[3])
 
     def attrdict(self):
-        return { key: self.__dict__[key] for key in self.__dict__.keys() if key in self.attrs }
+        return { key: getattr(self, key) for key in self.attrs }
 
     def __eq__(self, other):
         return not ( other is None or self.attrdict() != other.attrdict() )
@@ -70,17 +580,18 @@ class Point(object):
     def latlonalt(self):
         return (self.Latitude, self.Longitude, self.Altitude)
 
-    def bearingto(self, to):
-        return WayPoint.to360(Geodesic.WGS84.Inverse(self.Latitude, self.Longitude, to.Latitude, to.Longitude)['azi1'])
+    def bearingto(self, to, fast=False):
+        return WayPoint.to360(Geo.inverse(self.Latitude, self.Longitude, to.Latitude, to.Longitude, fast)[1])
 
-    def distanceto(self, to):
-        return Geodesic.WGS84.Inverse(self.Latitude, self.Longitude, to.Latitude, to.Longitude)['s12']
+    def distanceto(self, to, fast=False):
+        return Geo.inverse(self.Latitude, self.Longitude, to.Latitude, to.Longitude, fast)[0]
 
-    def distance3d(self, to):
-        return math.sqrt(self.distanceto(to)**2 + (self.Altitude - to.Altitude)**2)
+    def distance3d(self, to, fast=False):
+        s = Geo.inverse(self.Latitude, self.Longitude, to.Latitude, to.Longitude, fast)[0]
+        return math.sqrt(s**2 + (self.Altitude - to.Altitude)**2)
 
-    def tiltto(self, to):
-        return math.degrees(math.asin( (to.Altitude - self.Altitude) / self.distance3d(to) )) + 90.0
+    def tiltto(self, to, fast=False):
+        return Geo.tilt(self.latlonalt(), to.latlonalt(), self.distance3d(to, fast))
 
     def altcorrect(self, takeoffalt, groundalt):
         self.GroundAlt = groundalt
@@ -95,6 +606,7 @@ class Point(object):
 
 class WayPoint(Point):
     attrs = Point.attrs + ['Heading', 'CurveSize', 'RotationDir', 'GimbalMode', 'GimbalTilt', 'Speed', 'Distance', 'LegTime', 'Bearing', 'Num', 'ActionType', 'ActionParam', 'Poi']
+    __slots__ = attrs[len(Point.attrs):]
     def __init__(self, **kv):
         super(WayPoint, self).__init__(**kv)
         if self.ActionType == 0:
@@ -119,64 +631,387 @@ class WayPoint(Point):
         return wp
 
     def copy(self, full=False):
-        new = copy.deepcopy(self)
-        if not full:
+        new = WayPoint.__new__(WayPoint)
+        for i in self.attrs:
+            setattr(new, i, getattr(self, i))
+        if full:
+            new.ActionType, new.ActionParam = list(self.ActionType), list(self.ActionParam)
+        else:
             new.ActionType, new.ActionParam, new.Num = [], [], None
         return new
 
+class Mission(object):
+    # Radius is the turn radius of the path at a point, infinite on straight legs and 0 at corners
+    floats = ['Latitude', 'Longitude', 'Altitude', 'GroundAlt', 'Heading', 'CurveSize', 'RotationDir', 'GimbalTilt', 'Speed', 'Distance', 'LegTime', 'Bearing', 'Radius']
+    ints = ['AltMode', 'GimbalMode', 'Num']
+    objects = ['ActionType', 'ActionParam', 'Poi']
+
+    def __init__(self):
+        for i in self.floats:
+            setattr(self, i, array.array('d'))
+        for i in self.ints:
+            setattr(self, i, array.array('l'))
+        for i in self.objects:
+            setattr(self, i, [])
+
+    def __len__(self):
+        return len(self.Latitude)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Mission index out of range')
+        return MissionPoint(self, i)
+
+    def __iter__(self):
+        for i in range(0, len(self)):
+            yield MissionPoint(self, i)
+
+    def extend(self, other, a=0, b=None):
+        for i in self.floats + self.ints + self.objects:
+            getattr(self, i).extend(getattr(other, i)[a:b])
+
+    def append(self, wp, full=True, **kv):
+        # kv overrides attributes of wp, a non-full copy drops actions and numbering
+        if not full:
+            kv.setdefault('ActionType', [])
+            kv.setdefault('ActionParam', [])
+            kv.setdefault('Num', None)
+        for i in self.floats + self.ints + self.objects:
+            # plain waypoints have no Radius, they count as straight
+            v = kv[i] if i in kv else getattr(wp, i, float('inf'))
+            getattr(self, i).append(v or 0 if i == 'Num' else v)
+
+class MissionPoint(WayPoint):
+    __slots__ = ['mission', 'index']
+    def __init__(self, mission, index):
+        self.mission = mission
+        self.index = index
+
+    @staticmethod
+    def column(name):
+        if name == 'Num':
+            return property(lambda self: self.mission.Num[self.index] or None, lambda self, v: self.mission.Num.__setitem__(self.index, v or 0))
+        return property(lambda self: getattr(self.mission, name)[self.index], lambda self, v: getattr(self.mission, name).__setitem__(self.index, v))
+
+for i in WayPoint.attrs + ['Radius']:
+    setattr(MissionPoint, i, MissionPoint.column(i))
+
+class ChunkSink(io.RawIOBase):
+    # unseekable write target, lets zipfile stream instead of seeking back
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+class KMLStream(object):
+    HEADER = '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:atom="http://www.w3.org/2005/Atom" xmlns:gx="http://www.google.com/kml/ext/2.2">\n'
+    FOOTER = '</kml>\n'
+
+    # specs are (tag, text) or (tag, [child specs]) with an optional attribute dict,
+    # rendered the same way as lxml pretty_print renders the pykml tree
+    @classmethod
+    def element(cls, spec, depth):
+        tag, content = spec[0], spec[1]
+        attrs = ''.join([' {0}={1}'.format(k, cls.quoteattr(str(v))) for k, v in sorted(spec[2].items())]) if len(spec) > 2 else ''
+        pad = '  ' * depth
+        if isinstance(content, list):
+            if not content:
+                return pad + '<' + tag + attrs + '/>\n'
+            return pad + '<' + tag + attrs + '>\n' + ''.join([cls.element(i, depth + 1) for i in content]) + pad + '</' + tag + '>\n'
+        return pad + '<' + tag + attrs + '>' + cls.escape(str(content)) + '</' + tag + '>\n'
+
+    # xml.sax.saxutils equivalents, that module drags in urllib.request
+    @staticmethod
+    def escape(data):
+        return data.replace('&', '&amp;').replace('>', '&gt;').replace('<', '&lt;')
+
+    @classmethod
+    def quoteattr(cls, data):
+        data = cls.escape(data).replace('\n', '&#10;').replace('\r', '&#13;').replace('\t', '&#9;')
+        if '"' in data:
+            if "'" in data:
+                return '"' + data.replace('"', '&quot;') + '"'
+            return "'" + data + "'"
+        return '"' + data + '"'
+
+    @staticmethod
+    def open(tag, depth):
+        return '  ' * depth + '<' + tag + '>\n'
+
+    @staticmethod
+    def close(tag, depth):
+        return '  ' * depth + '</' + tag + '>\n'
+
+    @staticmethod
+    def chunks(pieces, chunksize=65536):
+        buf, size = [], 0
+        for piece in pieces:
+            buf.append(piece)
+            size += len(piece)
+            if size >= chunksize:
+                yield ''.join(buf).encode('ascii', 'xmlcharrefreplace')
+                buf, size = [], 0
+        if buf:
+            yield ''.join(buf).encode('ascii', 'xmlcharrefreplace')
+
+    @staticmethod
+    def kmz(chunks):
+        import zipfile
+        sink = ChunkSink()
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as z:
+            with z.open('doc.kml', 'w') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    for i in sink.drain():
+                        yield i
+        for i in sink.drain():
+            yield i
+
+class Keyframes(object):
+    # little endian header, utf-8 mission name padded to 8 bytes, then fixed width
+    # records for smoothed keyframes, numbered waypoints and POIs
+    MAGIC = b'VLMK'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHdIIII')
+    KEYFRAME = struct.Struct('<6di4x')
+    WAYPOINT = struct.Struct('<6di4x')
+    POI = struct.Struct('<4d')
+
+    @classmethod
+    def dump(cls, conv, f):
+        name = conv.mission.encode('utf-8')
+        sm = conv.smoothed
+        f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0, conv.hfov, len(sm), len(conv.waypoints), len(conv.pois), len(name)))
+        f.write(name + b'\0' * (-len(name) % 8))
+        for i in range(0, len(sm), 4096):
+            f.write(b''.join([cls.KEYFRAME.pack(*i) for i in zip(*[getattr(sm, k)[i:i+4096] for k in ('Latitude', 'Longitude', 'Altitude', 'Heading', 'GimbalTilt', 'LegTime', 'Num')])]))
+        f.write(b''.join([cls.WAYPOINT.pack(wp.Latitude, wp.Longitude, wp.Altitude, wp.GroundAlt, wp.Heading, wp.GimbalTilt, wp.Num) for wp in conv.waypoints]))
+        f.write(b''.join([cls.POI.pack(poi.Latitude, poi.Longitude, poi.Altitude, poi.GroundAlt) for poi in conv.pois]))
+
+    @classmethod
+    def load(cls, path, conv=None):
+        # fills conv with what the KML writer needs, readcsv and smooth are not run
+        conv = conv or Convert()
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(mm) < cls.HEADER.size:
+                raise ValueError('Truncated keyframe file')
+            magic, version, flags, hfov, nkeys, nwps, npois, namelen = cls.HEADER.unpack_from(mm)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError('Not a keyframe file')
+            off = cls.HEADER.size + namelen + (-namelen % 8)
+            sizes = [nkeys * cls.KEYFRAME.size, nwps * cls.WAYPOINT.size, npois * cls.POI.size]
+            if len(mm) != off + sum(sizes):
+                raise ValueError('Truncated keyframe file')
+            conv.mission = mm[cls.HEADER.size:cls.HEADER.size + namelen].decode('utf-8')
+            conv.hfov = hfov
+            view = memoryview(mm)
+            try:
+                keys = list(zip(*cls.KEYFRAME.iter_unpack(view[off:off + sizes[0]]))) or [()] * 7
+                wps = cls.WAYPOINT.iter_unpack(view[off + sizes[0]:off + sizes[0] + sizes[1]])
+                pois = cls.POI.iter_unpack(view[off + sizes[0] + sizes[1]:])
+                conv.smoothed = Mission()
+                for k, v in zip(('Latitude', 'Longitude', 'Altitude', 'Heading', 'GimbalTilt', 'LegTime'), keys):
+                    setattr(conv.smoothed, k, array.array('d', v))
+                conv.smoothed.Num = array.array('l', keys[6])
+                for k in Mission.floats + Mission.ints:
+                    if not len(getattr(conv.smoothed, k)):
+                        setattr(conv.smoothed, k, array.array(getattr(conv.smoothed, k).typecode, [0]) * nkeys)
+                conv.smoothed.ActionType, conv.smoothed.ActionParam, conv.smoothed.Poi = [[] for i in range(0, nkeys)], [[] for i in range(0, nkeys)], [None] * nkeys
+                conv.waypoints = [WayPoint(Latitude=i[0], Longitude=i[1], Altitude=i[2], GroundAlt=i[3], Heading=i[4], GimbalTilt=i[5], Num=i[6]) for i in wps]
+                conv.pois = [Point(Latitude=i[0], Longitude=i[1], Altitude=i[2], GroundAlt=i[3]) for i in pois]
+            finally:
+                view.release()
+        finally:
+            mm.close()
+        conv.spans = []
+        return conv
+
 class Convert(object):
-    def __init__(self, googlekey='', openapiurl='', speed=10.0, fov=85.0, hfov=None, takeoffalt=None, mincurve=5.0, nbezier=5, infilldist=1000.0, headingmode=3):
+    WPBALLOON = '\n<h3>WayPoint $[Waypoint]</h3>\n<table border="0" width="200">\n<tr><td>Altitude (msl) <td>$[Altitude_Abs] m\n<tr><td>Altitude (rtg) <td>$[Altitude_Gnd] m\n<tr><td>Heading<td>$[Heading] degrees\n<tr><td>Gimbal Tilt<td> $[Gimbal] degrees\n</tr></table>\n'
+    POIBALLOON = '\n<h3>POI $[POI]</h3>\n <table border="0" width="200">\n <tr><td>Altitude (msl) <td>$[Altitude_Abs] m\n <tr><td>Altitude (rtg) <td>$[Altitude_Gnd] m\n </tr></table>\n'
+
+
+    def __init__(self, googlekey='', openapiurl='', speed=10.0, fov=85.0, hfov=None, takeoffalt=None, mincurve=5.0, nbezier=5, infilldist=1000.0, headingmode=3, elevcache=None, elevation=None, fastgeo=False, metrics=None, tolerance=None, maxturn=10.0, simplify=None, incremental=False, frameinterval=None, accel=2.0, maxwaypoints=None, maxsmoothed=None):
+        if accel <= 0:
+            raise ValueError('accel must be positive')
+        if frameinterval is not None and frameinterval <= 0:
+            raise ValueError('frameinterval must be positive')
         self.googlekey = googlekey
         self.openapiurl = openapiurl
+        self.elevcache = elevcache
+        self.elevation = elevation
         self.takeoffalt = takeoffalt
+        self.fixedtakeoff = takeoffalt
         self.defspeed = speed
         self.hfov = hfov or Convert.HFOV(fov)
         self.mincurve = mincurve
         self.nbezier = nbezier
         self.infilldist = infilldist
         self.headingmode = headingmode
+        self.fastgeo = fastgeo
+        self.metrics = metrics
+        self.tolerance = tolerance
+        self.maxturn = maxturn
+        self.simplify = simplify
+        self.incremental = incremental
+        self.frameinterval = frameinterval
+        self.accel = accel
+        self.maxwaypoints = maxwaypoints
+        self.maxsmoothed = maxsmoothed
         self.metric = True
         self.waypoints = []
         self.pois = []
         self.smoothed = []
+        # with incremental set, path segments, span headings and KML fragments of the
+        # last run are kept, keyed by the waypoints they depend on
+        self.segments = {}
+        self.headings = {}
+        self.fragments = {}
+        self.spans = []
 
     @staticmethod
     def HFOV(dfov):
         return 2.0 * math.degrees(math.atan( math.tan(math.radians(dfov) / 2.0) * 16.0/math.sqrt(16.0**2+9.0**2) ))
 
-    def readcsv(self, source, mission='mission'):
+    @staticmethod
+    def csvsource(source):
+        # bytes, str, text or binary files and iterables of lines
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = bytes(source).decode('utf-8-sig')
+        if isinstance(source, str):
+            return Convert.csvlines(source)
+        if isinstance(source, (io.RawIOBase, io.BufferedIOBase)) or 'b' in getattr(source, 'mode', ''):
+            return io.TextIOWrapper(source, 'utf-8-sig', newline='')
+        return source
+
+    @staticmethod
+    def csvlines(text):
+        # a StringIO would hold a second copy of the text at up to 4 bytes per character
+        start = 0
+        while start < len(text):
+            end = text.find('\n', start) + 1 or len(text)
+            yield text[start:end]
+            start = end
+
+    @staticmethod
+    def csvrow(line):
+        # pads short rows with the values that mean "not set"
+        if len(line) > 43:
+            return line
+        return line[:8] + (line[8:38] if len(line) > 37 else ['-1', '0'] * 15) + [line[38] if len(line) > 38 else '0', line[39] if len(line) > 39 else '0', '0', '0', '0', '0']
+
+    @staged('parsecsv')
+    def parsecsv(self, source, mission='mission'):
         self.mission = mission
         self.waypoints = []
         self.pois = []
-        reader = csv.reader(source, delimiter=',', quotechar='"')
-        header = self.checkheader(next(reader))
+        reader = csv.reader(self.csvsource(source), delimiter=',', quotechar='"')
+        header = next(reader, None)
+        if header is None:
+            raise ValueError('Mismatching CSV header')
+        self.checkheader(header)
+        # rows are converted as they are read into typed columns, action type and
+        # parameter pairs go into one flat column with 30 values per row
+        fcols, icols = (0, 1, 2, 3, 4, 5, 7, 39, 40, 41, 42), (6, 38)
+        floats = [array.array('d') for i in fcols]
+        ints = [array.array('q') for i in icols]
+        actions = array.array('q')
+        poimode = []
+        count = 0
         for line in reader:
-            if len(line)<8:
+            if len(line) < 8:
                 continue
-            wp = WayPoint.fromcsvline(line)
-            if not self.metric:
-                wp.Altitude /= 3.28084
-                wp.CurveSize /= 3.28084
-                if wp.Poi:
-                    wp.Poi.Altitude /= 3.28084
-            if wp.Speed == 0:
-                wp.Speed = self.defspeed
-            if self.waypoints:
-                wp.Distance = wp.distanceto(self.waypoints[-1])
-                wp.Bearing = self.waypoints[-1].bearingto(wp)
-            wp.GimbalTilt += 90.0
-            if self.waypoints and wp.GimbalMode == 0:
-                wp.GimbalTilt = self.waypoints[-1].GimbalTilt
-            if wp.Poi and wp.Poi not in self.pois:
-                self.pois.append(wp.Poi)
-            elif wp.Poi:
-                wp.Poi = self.pois[self.pois.index(wp.Poi)]
-            wp.Num = len(self.waypoints)+1
+            if self.maxwaypoints and count >= self.maxwaypoints:
+                raise LimitError('More than {0} waypoints'.format(self.maxwaypoints))
+            line = self.csvrow(line)
+            for col, i in zip(floats, fcols):
+                col.append(float(line[i]))
+            for col, i in zip(ints, icols):
+                col.append(int(line[i]))
+            actions.extend(map(int, line[8:38]))
+            poimode.append(line[43])
+            count += 1
+        lat, lon, alt, heading, curve, rotation, tilt, speed, poilat, poilon, poialt = floats
+        gimbal, altmode = ints
+        if not self.metric:
+            alt = [i / 3.28084 for i in alt]
+            curve = [i / 3.28084 for i in curve]
+            poialt = [i / 3.28084 for i in poialt]
+        pois = {}
+        prev = None
+        for i in range(0, count):
+            wp = WayPoint.__new__(WayPoint)
+            wp.Latitude, wp.Longitude, wp.Altitude, wp.Heading, wp.CurveSize, wp.RotationDir = lat[i], lon[i], alt[i], heading[i], curve[i], rotation[i]
+            wp.GimbalMode, wp.AltMode, wp.GroundAlt = gimbal[i], altmode[i], 0
+            wp.Speed = speed[i] or self.defspeed
+            wp.ActionType = [t for t in actions[30*i:30*i+30:2] if t != -1]
+            wp.ActionParam = list(actions[30*i+1:30*i+30:2][:len(wp.ActionType)])
+            wp.LegTime = 0
+            if prev:
+                wp.Distance, wp.Bearing = Geo.inverse(prev.Latitude, prev.Longitude, wp.Latitude, wp.Longitude, self.fastgeo)
+                wp.Bearing = WayPoint.to360(wp.Bearing)
+            else:
+                wp.Distance, wp.Bearing = 0, 0
+            wp.GimbalTilt = prev.GimbalTilt if prev and wp.GimbalMode == 0 else tilt[i] + 90.0
+            wp.Poi = None
+            if poilat[i] != 0.0 or poilon[i] != 0.0:
+                k = (poilat[i], poilon[i], poialt[i], int(poimode[i]))
+                wp.Poi = pois.get(k)
+                if wp.Poi is None:
+                    wp.Poi = pois[k] = Point.fromtuple(k)
+                    self.pois.append(wp.Poi)
+            wp.Num = i + 1
             self.waypoints.append(wp)
-        elevations = Elevation(key=self.googlekey, openapi=self.openapiurl).request([i.latlonalt() for i in self.waypoints + self.pois])
+            prev = wp
+        if self.metrics:
+            self.metrics.inc('vlm_points_total', len(self.waypoints), kind='waypoints')
+            self.metrics.inc('vlm_points_total', len(self.pois), kind='pois')
+
+    def readcsv(self, source, mission='mission'):
+        self.parsecsv(source, mission)
+        self.elevate(self.requestelevation())
+
+    @staged('elevation')
+    def requestelevation(self, latlons=None):
+        return (self.elevation or Elevation(key=self.googlekey, openapi=self.openapiurl, cache=self.elevcache, metrics=self.metrics)).request(self.latlons() if latlons is None else latlons)
+
+    def update(self, source, mission=None):
+        # re-convert an edited mission, only new positions are looked up and only spans next to edits are rebuilt
+        grounds = dict([((p.Latitude, p.Longitude), p.GroundAlt) for p in self.waypoints + self.pois])
+        self.parsecsv(source, mission or self.mission)
+        latlons = self.latlons()
+        missing = list(collections.OrderedDict.fromkeys([i[:2] for i in latlons if i[:2] not in grounds]))
+        if missing:
+            grounds.update(zip(missing, self.requestelevation([i + (0.0,) for i in missing])))
+        self.takeoffalt = self.fixedtakeoff
+        self.elevate([grounds[i[:2]] for i in latlons])
+        self.smooth()
+        return len(missing)
+
+    @staticmethod
+    def signature(wp):
+        return tuple([getattr(wp, i) for i in WayPoint.attrs[:-4]] + [tuple(wp.ActionType), tuple(wp.ActionParam), wp.Poi and tuple(wp.Poi.attrdict().items())])
+
+    def latlons(self):
+        return [i.latlonalt() for i in self.waypoints + self.pois]
+
+    def elevate(self, elevations):
         self.takeoffalt = self.takeoffalt or elevations[0]
-        for p in self.waypoints + self.pois:
-            p.altcorrect(self.takeoffalt, elevations.pop(0))
+        for p, e in zip(self.waypoints + self.pois, elevations):
+            p.altcorrect(self.takeoffalt, e)
 
     def checkheader(self, header):
         if header[0] != 'latitude' or header[5] != 'rotationdir':
@@ -189,77 +1024,287 @@ class Convert(object):
             raise ValueError('Mismatching CSV header')
         return header
 
-    def appendsmoothed(self, wp):
-        wp.Distance = wp.distance3d(self.smoothed[-1])
-        wp.LegTime = wp.Distance / self.smoothed[-1].Speed
-        self.smoothed.append(wp)
+    def appendsmoothed(self, wp, full=True, lla=None, radius=float('inf')):
+        lla = lla or wp.latlonalt()
+        pp = self.smoothed[-1]
+        s = Geo.inverse(lla[0], lla[1], pp.Latitude, pp.Longitude, self.fastgeo)[0]
+        distance = math.sqrt(s**2 + (lla[2] - pp.Altitude)**2)
+        self.smoothed.append(wp, full, Latitude=lla[0], Longitude=lla[1], Altitude=lla[2], Distance=distance, LegTime=distance / pp.Speed, Radius=radius)
 
-    def fillto(self, wp):
+    def fillto(self, wp, full=True, lla=None, radius=float('inf'), curved=False):
+        # infill points are straight, or share the radius of the curve point they lead to
+        lla = lla or wp.latlonalt()
         pp = self.smoothed[-1]
-        d = math.ceil(pp.distance3d(wp)/self.infilldist)
+        s = Geo.inverse(pp.Latitude, pp.Longitude, lla[0], lla[1], self.fastgeo)[0]
+        if self.tolerance:
+            # the chord error of linear interpolation drops with the square of the split count
+            d = math.ceil(math.sqrt(Geo.chorderror(pp.latlonalt(), lla) / self.tolerance)) if s > Geo.FASTLIMIT else 1
+        else:
+            d = math.ceil(math.sqrt(s**2 + (pp.Altitude - lla[2])**2)/self.infilldist)
+        if self.maxsmoothed and len(self.smoothed) + d > self.maxsmoothed:
+            raise LimitError('More than {0} smoothed points'.format(self.maxsmoothed))
         for j in range(1, int(d)):
-            sp = pp.copy()
-            sp.Latitude = pp.Latitude + j * (wp.Latitude - pp.Latitude) / d
-            sp.Longitude = pp.Longitude + j * (wp.Longitude - pp.Longitude) / d
-            sp.Altitude = pp.Altitude + j * (wp.Altitude - pp.Altitude) / d
-            self.appendsmoothed(sp)
-        self.appendsmoothed(wp)
+            self.appendsmoothed(pp, False, (
+                pp.Latitude + j * (lla[0] - pp.Latitude) / d,
+                pp.Longitude + j * (lla[1] - pp.Longitude) / d,
+                pp.Altitude + j * (lla[2] - pp.Altitude) / d,
+                ), radius if curved else float('inf'))
+        self.appendsmoothed(wp, full, lla, radius)
 
     @staticmethod
     def bezier(a, t):
         return (a[0] - 2.0 * a[1] + a[2]) * t * t + 2.0 * (a[1] - a[0]) * t + a[0]
 
-    def addbezier(self, sp, bz, s):
-        sp.Latitude, sp.Longitude, sp.Altitude = self.bezier(bz[0], s), self.bezier(bz[1], s), self.bezier(bz[2], s)
-        self.fillto(sp)
+    @staticmethod
+    def bezierradius(bz, s):
+        # radius of curvature on the tangent plane at the control point, B' x B'' over |B'|^3
+        p0, p2 = [Geo.local([b[1] for b in bz], [b[k] for b in bz]) for k in (0, 2)]
+        d1 = [2.0 * (s * p2[k] - (1.0 - s) * p0[k]) for k in range(0, 3)]
+        d2 = [2.0 * (p0[k] + p2[k]) for k in range(0, 3)]
+        cross = math.sqrt((d1[1] * d2[2] - d1[2] * d2[1])**2 + (d1[2] * d2[0] - d1[0] * d2[2])**2 + (d1[0] * d2[1] - d1[1] * d2[0])**2)
+        return math.sqrt(sum([k**2 for k in d1]))**3 / cross if cross else float('inf')
+
+    def addbezier(self, wp, full, bz, s):
+        self.fillto(wp, full, (self.bezier(bz[0], s), self.bezier(bz[1], s), self.bezier(bz[2], s)), self.bezierradius(bz, s), s > 0.0)
+
+    def subdivide(self, bz, s0, s1, depth=0):
+        # curve parameters inside (s0, s1) keeping chord error and tangent turn within limits
+        m = (s0 + s1) / 2.0
+        p0, pm, p1 = [[self.bezier(b, s) for b in bz] for s in (s0, m, s1)]
+        e, n, u = Geo.local(p0, [pm[i] - (p1[i] - p0[i]) / 2.0 for i in range(0, 3)])
+        err = math.sqrt(e**2 + n**2 + u**2)
+        t0, t1 = [Geo.local(bz[1], [bz[i][1] + (bz[i][2] - bz[i][1]) * s + (bz[i][1] - bz[i][0]) * (1.0 - s) for i in range(0, 3)]) for s in (s0, s1)]
+        dot = sum([t0[i] * t1[i] for i in range(0, 3)])
+        norm = math.sqrt(sum([i**2 for i in t0]) * sum([i**2 for i in t1]))
+        turn = math.degrees(math.acos(max(-1.0, min(1.0, dot / norm)))) if norm else 0.0
+        if depth >= 8 or (err <= self.tolerance and turn <= self.maxturn):
+            return []
+        return self.subdivide(bz, s0, m, depth + 1) + [m] + self.subdivide(bz, m, s1, depth + 1)
+
+    def douglaspeucker(self, a, b):
+        # indexes of smoothed points between a and b deviating more than the simplify distance
+        sm = self.smoothed
+        origin = sm[a].latlonalt()
+        pts = [Geo.local(origin, (sm.Latitude[i], sm.Longitude[i], sm.Altitude[i])) for i in range(a, b + 1)]
+        keep = []
+        stack = [(0, b - a)]
+        while stack:
+            i, j = stack.pop()
+            d = [pts[j][k] - pts[i][k] for k in range(0, 3)]
+            dd = sum([k**2 for k in d])
+            worst, dist = None, self.simplify
+            for k in range(i + 1, j):
+                v = [pts[k][l] - pts[i][l] for l in range(0, 3)]
+                t = max(0.0, min(1.0, sum([v[l] * d[l] for l in range(0, 3)]) / dd)) if dd else 0.0
+                e = math.sqrt(sum([(v[l] - t * d[l])**2 for l in range(0, 3)]))
+                if e > dist:
+                    worst, dist = k, e
+            if worst is not None:
+                keep.append(a + worst)
+                stack += [(i, worst), (worst, j)]
+        return keep
+
+    def simplified(self):
+        # numbered waypoints always survive, legs are recomputed between the kept points
+        sm = self.smoothed
+        numbered = [i for i in range(0, len(sm)) if sm.Num[i]]
+        keep = set([0, len(sm) - 1] + numbered)
+        for a, b in zip([0] + numbered, numbered + [len(sm) - 1]):
+            if b - a > 1:
+                keep.update(self.douglaspeucker(a, b))
+        self.smoothed = Mission()
+        self.smoothed.append(sm[0])
+        for i in sorted(keep)[1:]:
+            self.appendsmoothed(sm[i], radius=sm.Radius[i])
+
+    def smoothsegment(self, wi):
+        if wi == len(self.waypoints) - 1:
+            self.fillto(self.waypoints[-1])
+            return
+        pp, wp, np = self.waypoints[wi-1:wi+2]
+        if wp.CurveSize < self.mincurve:
+            self.fillto(wp, radius=0.0)
+            return
+        bz = [
+                [ wp.latlonalt()[i] - min(0.45, wp.CurveSize / wp.Distance) * (wp.latlonalt()[i] - pp.latlonalt()[i]),
+                  wp.latlonalt()[i],
+                  wp.latlonalt()[i] + min(0.45, wp.CurveSize / np.Distance) * (np.latlonalt()[i] - wp.latlonalt()[i]),
+                ] for i in range(0, 3)
+             ]
+        if self.tolerance:
+            self.addbezier(wp, False, bz, 0.0)
+            for s in self.subdivide(bz, 0.0, 0.5):
+                self.addbezier(wp, False, bz, s)
+            self.addbezier(wp, True, bz, 0.5)
+            for s in self.subdivide(bz, 0.5, 1.0):
+                self.addbezier(wp, False, bz, s)
+            self.addbezier(wp, False, bz, 1.0)
+            return
+        for b in range(0, self.nbezier):
+            s = b / (self.nbezier - 1.0)
+            if s != 0.5 or self.nbezier % 2 == 0:
+                self.addbezier(wp, False, bz, s)
+            if b == (self.nbezier - 1)//2:
+                self.addbezier(wp, True, bz, 0.5)
 
+    @staged('smooth')
     def smooth(self):
-        self.smoothed = [self.waypoints[0].copy(full=True)]
-        for wi in range(1, len(self.waypoints)-1):
-            pp, wp, np = self.waypoints[wi-1:wi+2]
-            if wp.CurveSize < self.mincurve:
-                self.fillto(wp.copy(full=True))
-                continue
-            bz = [
-                    [ wp.latlonalt()[i] - min(0.45, wp.CurveSize / wp.Distance) * (wp.latlonalt()[i] - pp.latlonalt()[i]),
-                      wp.latlonalt()[i],
-                      wp.latlonalt()[i] + min(0.45, wp.CurveSize / np.Distance) * (np.latlonalt()[i] - wp.latlonalt()[i]),
-                    ] for i in range(0, 3)
-                 ]
-            for b in range(0, self.nbezier):
-                s = b / (self.nbezier - 1.0)
-                if s != 0.5 or self.nbezier % 2 == 0:
-                    self.addbezier(wp.copy(), bz, s)
-                if b == (self.nbezier - 1)//2:
-                    self.addbezier(wp.copy(full=True), bz, 0.5)
-        if len(self.waypoints)>1:
-            self.fillto(self.waypoints[-1].copy(full=True))
-
-        numbered = [i for i in range(0, len(self.smoothed)) if not self.smoothed[i].Num is None]
+        # a segment depends on two waypoints back and one ahead, a span between
+        # numbered points also on the segments around it
+        sigs = [self.signature(i) for i in self.waypoints] if self.incremental else None
+        deps = lambda a, b: tuple([sigs[i] if 0 <= i < len(sigs) else None for i in range(a, b)]) if sigs else None
+        segments, self.segments = self.segments, {}
+        self.smoothed = Mission()
+        self.smoothed.append(self.waypoints[0])
+        for wi in range(1, len(self.waypoints)):
+            key, start = deps(wi-2, wi+2), len(self.smoothed)
+            if key in segments:
+                self.smoothed.extend(segments[key])
+            else:
+                self.smoothsegment(wi)
+                if key:
+                    segments[key] = Mission()
+                    segments[key].extend(self.smoothed, start)
+            if key:
+                self.segments[key] = segments[key]
+        if self.simplify:
+            self.simplified()
+
+        sm = self.smoothed
+        numbered = [i for i in range(0, len(sm)) if sm.Num[i]]
+        # reused segments carry the numbers of the waypoints they were built for
+        for wi in range(0, len(numbered)):
+            sm.Num[numbered[wi]] = wi + 1
+        headings, self.headings = self.headings, {}
+        self.spans = [(deps(wi-2, wi+3), numbered[wi], numbered[wi+1] if wi+1 < len(numbered) else len(sm)) for wi in range(0, len(numbered))]
         for wi in range(0, len(numbered)-1):
-            wp, np = self.smoothed[numbered[wi]], self.smoothed[numbered[wi+1]]
+            key, a, b = self.spans[wi]
+            if key in headings and len(headings[key][0]) == b - a:
+                sm.Heading[a:b], sm.GimbalTilt[a:b] = headings[key]
+                self.headings[key] = headings[key]
+                continue
+            wp, np = sm[numbered[wi]], sm[numbered[wi+1]]
             diffhead = np.Heading - wp.Heading
             if diffhead > 180.0:
                 diffhead -= 360.0
             elif diffhead < -180:
                 diffhead += 360.0
             difftilt = np.GimbalTilt - wp.GimbalTilt
-            for si in range(numbered[wi], numbered[wi+1]):
-                sp = self.smoothed[si]
-                wd = sp.distance3d(wp)
-                nd = sp.distance3d(np)
-                if wp.Poi and wp.Poi == np.Poi:
-                    sp.Heading = sp.bearingto(wp.Poi)
-                elif self.headingmode == 0:
-                    sp.Heading = sp.bearingto(self.smoothed[si+1])
+            poi = wp.Poi and wp.Poi == np.Poi
+            poitilt = poi and wp.GimbalMode == 1 and np.GimbalMode == 1
+            a, b = numbered[wi], numbered[wi+1]
+            seg = list(zip(sm.Latitude[a:b], sm.Longitude[a:b], sm.Altitude[a:b]))
+            if not poitilt:
+                wlegs = Geo.legs(seg, wp.latlonalt(), self.fastgeo)
+                nlegs = Geo.legs(seg, np.latlonalt(), self.fastgeo)
+            if poi:
+                plegs = Geo.legs(seg, wp.Poi.latlonalt(), self.fastgeo)
+            elif self.headingmode == 0:
+                plegs = Geo.legs(seg, seg[1:] + [np.latlonalt()], self.fastgeo)
+            for k in range(0, len(seg)):
+                if not poitilt:
+                    wd, nd = wlegs[k][2], nlegs[k][2]
+                if poi or self.headingmode == 0:
+                    sm.Heading[a+k] = WayPoint.to360(plegs[k][1])
                 else:
-                    sp.Heading = WayPoint.to360(wp.Heading + diffhead * wd / (wd+nd))
-                if wp.Poi and wp.Poi == np.Poi and wp.GimbalMode == 1 and np.GimbalMode == 1:
-                    sp.GimbalTilt = sp.tiltto(wp.Poi)
+                    sm.Heading[a+k] = WayPoint.to360(wp.Heading + diffhead * wd / (wd+nd))
+                if poitilt:
+                    sm.GimbalTilt[a+k] = Geo.tilt(seg[k], wp.Poi.latlonalt(), plegs[k][2])
                 else:
-                    sp.GimbalTilt = wp.GimbalTilt + difftilt * wd / (wd+nd)
+                    sm.GimbalTilt[a+k] = wp.GimbalTilt + difftilt * wd / (wd+nd)
+            if key:
+                self.headings[key] = (sm.Heading[a:b], sm.GimbalTilt[a:b])
+        if self.frameinterval:
+            self.retime()
+        if self.metrics:
+            self.metrics.inc('vlm_points_total', len(self.smoothed), kind='smoothed')
 
-    def getkml(self):
+    def profile(self):
+        # vertex speeds limited by segment speeds, lateral acceleration on curves, stops
+        # at corners and by accelerating or braking within accel along the path
+        sm = self.smoothed
+        n = len(sm)
+        pts = list(zip(sm.Latitude, sm.Longitude, sm.Altitude))
+        d = [0.0] + list(sm.Distance[1:])
+        vmax = [0.0] + list(sm.Speed[:-1])
+        v = [0.0] * n
+        for i in range(1, n - 1):
+            v[i] = min(vmax[i], vmax[i+1], math.sqrt(self.accel * sm.Radius[i]) if sm.Radius[i] else v[i])
+            if not sm.Radius[i]:
+                # waypoints without a curve are only stops when the path turns there
+                u, w = Geo.local(pts[i], pts[i-1]), Geo.local(pts[i], pts[i+1])
+                norm = math.sqrt(sum([k**2 for k in u]) * sum([k**2 for k in w]))
+                if norm and -sum([u[k] * w[k] for k in range(0, 3)]) / norm < math.cos(1e-6):
+                    v[i] = 0.0
+        for i in range(1, n):
+            v[i] = min(v[i], math.sqrt(v[i-1]**2 + 2.0 * self.accel * d[i]))
+        for i in range(n - 2, -1, -1):
+            v[i] = min(v[i], math.sqrt(v[i+1]**2 + 2.0 * self.accel * d[i+1]))
+        return d, vmax, v
+
+    @staticmethod
+    def trapezoid(d, v0, v1, vmax, a):
+        # accelerate, cruise, brake over d, returns duration, phase ends and cruise speed
+        vc = min(vmax, math.sqrt(max(0.0, (2.0 * a * d + v0**2 + v1**2) / 2.0)))
+        if d <= 0.0 or vc <= 0.0:
+            return 0.0, 0.0, 0.0, 0.0, vc
+        s1 = max(0.0, (vc**2 - v0**2) / (2.0 * a))
+        cruise = max(0.0, d - s1 - max(0.0, (vc**2 - v1**2) / (2.0 * a)))
+        t1 = (vc - v0) / a
+        t2 = t1 + cruise / vc
+        return t2 + (vc - v1) / a, t1, t2, s1, vc
+
+    @staticmethod
+    def travelled(seg, v0, a, t):
+        total, t1, t2, s1, vc = seg
+        if t <= t1:
+            return v0 * t + a * t * t / 2.0
+        if t <= t2:
+            return s1 + vc * (t - t1)
+        u = t - t2
+        return s1 + vc * (t2 - t1) + vc * u - a * u * u / 2.0
+
+    def retime(self):
+        # replaces the sampled path by keyframes every frameinterval seconds of flight,
+        # numbered waypoints stay as keyframes of their own
+        sm = self.smoothed
+        if len(sm) < 2:
+            return
+        d, vmax, v = self.profile()
+        segs = [None] + [self.trapezoid(d[i], v[i-1], v[i], vmax[i], self.accel) for i in range(1, len(sm))]
+        res = Mission()
+        res.append(sm[0], True, LegTime=0.0, Distance=0.0)
+        last = now = 0.0
+        frame = self.frameinterval
+        for i in range(1, len(sm)):
+            end = now + segs[i][0]
+            while frame < end - 1e-9:
+                f = min(1.0, self.travelled(segs[i], v[i-1], self.accel, frame - now) / d[i])
+                dh = (sm.Heading[i] - sm.Heading[i-1] + 540.0) % 360.0 - 180.0
+                res.append(sm[i-1], False,
+                        Latitude=sm.Latitude[i-1] + f * (sm.Latitude[i] - sm.Latitude[i-1]),
+                        Longitude=sm.Longitude[i-1] + f * (sm.Longitude[i] - sm.Longitude[i-1]),
+                        Altitude=sm.Altitude[i-1] + f * (sm.Altitude[i] - sm.Altitude[i-1]),
+                        Heading=WayPoint.to360(sm.Heading[i-1] + f * dh),
+                        GimbalTilt=sm.GimbalTilt[i-1] + f * (sm.GimbalTilt[i] - sm.GimbalTilt[i-1]),
+                        LegTime=frame - last)
+                last = frame
+                frame += self.frameinterval
+                if self.maxsmoothed and len(res) > self.maxsmoothed:
+                    raise LimitError('More than {0} smoothed points'.format(self.maxsmoothed))
+            now = end
+            if sm.Num[i] or i == len(sm) - 1:
+                res.append(sm[i], True, LegTime=now - last)
+                last = now
+                if frame - now < 1e-9:
+                    frame = now + self.frameinterval
+        for i in range(1, len(res)):
+            s = Geo.inverse(res.Latitude[i-1], res.Longitude[i-1], res.Latitude[i], res.Longitude[i], self.fastgeo)[0]
+            res.Distance[i] = math.sqrt(s**2 + (res.Altitude[i-1] - res.Altitude[i])**2)
+        self.smoothed = res
+        self.spans = []
+
+    def lookat(self):
         avgalt = sum([i.Altitude for i in self.waypoints]) / float(len(self.waypoints))
         minlat = min([i.Latitude for i in self.waypoints])
         minlon = min([i.Longitude for i in self.waypoints])
@@ -269,6 +1314,15 @@ class Convert(object):
             rang = abs(maxlon - minlon) * 60.0 * 1852.0 / (2.0 * math.sin(math.radians(self.hfov) / 2.0)) * 1.2
         else:
             rang = abs(maxlat - minlat) * 60.0 * 1852.0 / (2.0 * math.sin(math.radians(self.hfov) / 2.0)) * 16.0 / 9.0
+        return (minlat+maxlat)/2.0, (minlon+maxlon)/2.0, avgalt, rang
+
+    @staged('getkml')
+    def getkml(self):
+        # only the tree writer needs pykml and lxml
+        from pykml.factory import KML_ElementMaker as KML
+        from pykml.factory import GX_ElementMaker as GX
+        from lxml import etree
+        lat, lon, avgalt, rang = self.lookat()
         txtwaypoints = ' '.join(['%f,%f,%f' % (i.Longitude, i.Latitude, i.Altitude) for i in self.waypoints])
         txtsmoothed = ' '.join(['%f,%f,%f' % (i.Longitude, i.Latitude, i.Altitude) for i in self.smoothed])
 
@@ -282,8 +1336,8 @@ class Convert(object):
                 KML.Document(
                     KML.name(self.mission),
                     KML.LookAt(
-                        KML.latitude( (minlat+maxlat)/2.0 ),
-                        KML.longitude( (minlon+maxlon)/2.0 ),
+                        KML.latitude(lat),
+                        KML.longitude(lon),
                         KML.altitude(avgalt),
                         KML.heading(0),
                         KML.tilt(70),
@@ -307,12 +1361,12 @@ class Convert(object):
                         ),
                     KML.Style(
                         KML.IconStyle( KML.Icon(KML.href('http://maps.google.com/mapfiles/kml/paddle/wht-blank.png'),),),
-                        KML.BalloonStyle( KML.text('\n<h3>WayPoint $[Waypoint]</h3>\n<table border="0" width="200">\n<tr><td>Altitude (msl) <td>$[Altitude_Abs] m\n<tr><td>Altitude (rtg) <td>$[Altitude_Gnd] m\n<tr><td>Heading<td>$[Heading] degrees\n<tr><td>Gimbal Tilt<td> $[Gimbal] degrees\n</tr></table>\n'), KML.bgColor('ffffffbb'),),
+                        KML.BalloonStyle( KML.text(self.WPBALLOON), KML.bgColor('ffffffbb'),),
                         id='wpmarkers',
                         ),
                     KML.Style(
                         KML.IconStyle( KML.Icon(KML.href('http://maps.google.com/mapfiles/kml/paddle/red-stars.png'),),),
-                        KML.BalloonStyle( KML.text('\n<h3>POI $[POI]</h3>\n <table border="0" width="200">\n <tr><td>Altitude (msl) <td>$[Altitude_Abs] m\n <tr><td>Altitude (rtg) <td>$[Altitude_Gnd] m\n </tr></table>\n'), KML.bgColor('ffffffbb'),),
+                        KML.BalloonStyle( KML.text(self.POIBALLOON), KML.bgColor('ffffffbb'),),
                         id='poimarkers',
                         ),
                     KML.Folder(
@@ -432,11 +1486,333 @@ class Convert(object):
 
         return etree.tostring(virtmission, pretty_print=True)
 
+    def camera(self, wp):
+        return ('Camera', [
+            ('latitude', wp.Latitude),
+            ('longitude', wp.Longitude),
+            ('altitude', wp.Altitude),
+            ('heading', wp.Heading),
+            ('tilt', wp.GimbalTilt),
+            ('roll', 0),
+            ('altitudeMode', 'absolute'),
+            ('gx:horizFov', self.hfov),
+            ])
+
+    def linestring(self, coords, name, visibility, style):
+        yield KMLStream.open('Placemark', 3)
+        yield KMLStream.element(('name', name), 4) + KMLStream.element(('visibility', visibility), 4) + KMLStream.element(('styleUrl', style), 4)
+        yield KMLStream.open('LineString', 4)
+        yield KMLStream.element(('extrude', 1), 5) + KMLStream.element(('tessellate', 1), 5) + KMLStream.element(('altitudeMode', 'absolute'), 5)
+        yield '          <coordinates>'
+        coords = iter(coords)
+        sep = ''
+        while True:
+            part = ' '.join(['%f,%f,%f' % i for i in itertools.islice(coords, 1000)])
+            if not part:
+                break
+            yield sep + part
+            sep = ' '
+        yield '</coordinates>\n'
+        yield KMLStream.close('LineString', 4)
+        yield KMLStream.close('Placemark', 3)
+
+    def kmlpieces(self):
+        lat, lon, avgalt, rang = self.lookat()
+        yield KMLStream.HEADER
+        yield KMLStream.open('Document', 1)
+        yield KMLStream.element(('name', self.mission), 2)
+        yield KMLStream.element(('LookAt', [
+            ('latitude', lat),
+            ('longitude', lon),
+            ('altitude', avgalt),
+            ('heading', 0),
+            ('tilt', 70),
+            ('range', rang),
+            ('altitudeMode', 'absolute'),
+            ('gx:horizFov', self.hfov),
+            ]), 2)
+        yield KMLStream.open('gx:Tour', 2)
+        yield KMLStream.element(('name', 'Virtual Mission'), 3)
+        if not len(self.smoothed):
+            yield KMLStream.element(('gx:Playlist', []), 3)
+        else:
+            yield KMLStream.open('gx:Playlist', 3)
+            fragments, self.fragments = self.fragments, {}
+            for key, a, b in self.spans or [(None, 0, len(self.smoothed))]:
+                piece = fragments.get(key) if key else None
+                if piece is None:
+                    piece = ''.join([KMLStream.element(('gx:FlyTo', [('gx:duration', wp.LegTime), ('gx:flyToMode', 'smooth'), self.camera(wp)]), 4) +
+                            KMLStream.element(('gx:Wait', [('gx:duration', 0)]), 4) for wp in itertools.islice(self.smoothed, a, b)])
+                if key:
+                    self.fragments[key] = piece
+                yield piece
+            yield KMLStream.close('gx:Playlist', 3)
+        yield KMLStream.close('gx:Tour', 2)
+        for sid, line, poly in (('wpstyle', 'FF00FFFF', '4C00FFFF'), ('smoothstyle', 'FFFF00FF', '4CFF00FF')):
+            yield KMLStream.element(('Style', [('LineStyle', [('color', line), ('width', 2)]), ('PolyStyle', [('color', poly)])], {'id': sid}), 2)
+        for sid, icon, balloon in (('wpmarkers', 'wht-blank.png', self.WPBALLOON), ('poimarkers', 'red-stars.png', self.POIBALLOON)):
+            yield KMLStream.element(('Style', [
+                ('IconStyle', [('Icon', [('href', 'http://maps.google.com/mapfiles/kml/paddle/' + icon)])]),
+                ('BalloonStyle', [('text', balloon), ('bgColor', 'ffffffbb')]),
+                ], {'id': sid}), 2)
+        yield KMLStream.open('Folder', 2)
+        yield KMLStream.element(('name', 'Diagnostics'), 3)
+        for piece in self.linestring([(i.Longitude, i.Latitude, i.Altitude) for i in self.waypoints], 'WayPoint Path', 0, '#wpstyle'):
+            yield piece
+
+        yield KMLStream.open('Folder', 3)
+        yield KMLStream.element(('name', 'WayPoint Markers'), 4) + KMLStream.element(('visibility', 1), 4)
+        for wp in self.waypoints:
+            yield KMLStream.element(('Placemark', [
+                ('name', 'WP%02d' % (wp.Num)),
+                ('visibility', 1),
+                ('styleUrl', '#wpmarkers'),
+                ('ExtendedData', [
+                    ('Data', [('value', wp.Num)], {'name': 'Waypoint'}),
+                    ('Data', [('value', round(wp.Altitude, 0))], {'name': 'Altitude_Abs'}),
+                    ('Data', [('value', round(wp.Altitude-wp.GroundAlt, 0))], {'name': 'Altitude_Gnd'}),
+                    ('Data', [('value', round(wp.Heading, 0))], {'name': 'Heading'}),
+                    ('Data', [('value', round(wp.GimbalTilt-90.0, 0))], {'name': 'Gimbal'}),
+                    ]),
+                ('Point', [('altitudeMode', 'absolute'), ('extrude', 1), ('coordinates', '%f,%f,%f' % (wp.Longitude,wp.Latitude,wp.Altitude))]),
+                ]), 4)
+        yield KMLStream.close('Folder', 3)
+
+        yield KMLStream.open('Folder', 3)
+        yield KMLStream.element(('name', 'POI Markers'), 4) + KMLStream.element(('visibility', 1), 4)
+        for num, poi in enumerate(self.pois, 1):
+            yield KMLStream.element(('Placemark', [
+                ('name', 'POI%02d' % num),
+                ('visibility', 1),
+                ('styleUrl', '#poimarkers'),
+                ('ExtendedData', [
+                    ('Data', [('value', num)], {'name': 'POI'}),
+                    ('Data', [('value', round(poi.Altitude, 0))], {'name': 'Altitude_Abs'}),
+                    ('Data', [('value', round(poi.Altitude-poi.GroundAlt, 0))], {'name': 'Altitude_Gnd'}),
+                    ]),
+                ('Point', [('altitudeMode', 'absolute'), ('extrude', 1), ('coordinates', '%f,%f,%f' % (poi.Longitude,poi.Latitude,poi.Altitude))]),
+                ]), 4)
+        yield KMLStream.close('Folder', 3)
+
+        yield KMLStream.open('Folder', 3)
+        yield KMLStream.element(('name', 'WayPoint Views'), 4) + KMLStream.element(('visibility', 0), 4)
+        for wp in self.smoothed:
+            if wp.Num is None:
+                continue
+            yield KMLStream.element(('Document', [('name', 'WP%03d' % (wp.Num)), ('visibility', 0), self.camera(wp)]), 4)
+        yield KMLStream.close('Folder', 3)
+
+        for piece in self.linestring(zip(self.smoothed.Longitude, self.smoothed.Latitude, self.smoothed.Altitude), 'Smooth Flight Path', 1, '#smoothstyle'):
+            yield piece
+        yield KMLStream.close('Folder', 2)
+        yield KMLStream.close('Document', 1)
+        yield KMLStream.FOOTER
+
+    def iterkml(self, chunksize=65536):
+        chunks = KMLStream.chunks(self.kmlpieces(), chunksize)
+        return self.metrics.timed(chunks, 'kml') if self.metrics else chunks
+
+    def writekml(self, f):
+        for chunk in self.iterkml():
+            f.write(chunk)
+
+    def iterkmz(self, chunksize=65536):
+        return KMLStream.kmz(self.iterkml(chunksize))
+
+    def writekmz(self, f):
+        for chunk in self.iterkmz():
+            f.write(chunk)
+
     def run(self, cname, kname):
-        mission = os.path.basename(cname).rsplit('.', 1)[0]
-        self.readcsv(open(cname), mission)
-        self.smooth()
-        open(kname, 'wb').write(self.getkml())
+        if cname.lower().endswith('.vlmk'):
+            Keyframes.load(cname, self)
+        else:
+            mission = os.path.basename(cname).rsplit('.', 1)[0]
+            try:
+                self.readcsv(open(cname), mission)
+            except ElevationError as e:
+                print('FAIL {0}: {1}'.format(cname, e))
+                return 1
+            self.smooth()
+        self.write(kname)
+        return 0
+
+    def write(self, kname):
+        with open(kname, 'wb') as f:
+            if kname.lower().endswith('.vlmk'):
+                Keyframes.dump(self, f)
+            elif kname.lower().endswith('.kmz'):
+                self.writekmz(f)
+            else:
+                self.writekml(f)
+
+def batchfiles(inputs):
+    # directories, globs and @manifest files listing one input per line
+    files = []
+    for i in inputs:
+        if i.startswith('@'):
+            with open(i[1:]) as f:
+                files += batchfiles([l.strip() for l in f if l.strip() and not l.startswith('#')])
+        elif os.path.isdir(i):
+            files += sorted(glob.glob(os.path.join(i, '*.csv')))
+        elif any([c in i for c in '*?[']):
+            files += sorted(glob.glob(i))
+        else:
+            files.append(i)
+    return files
+
+def batchworker(conv, kname):
+    t = time.time()
+    conv.smooth()
+    conv.write(kname)
+    return time.time() - t
+
+class GeoHash(object):
+    BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+    @classmethod
+    def encode(cls, lat, lon, precision):
+        box = [[-90.0, 90.0], [-180.0, 180.0]]
+        res, ch, bits, even = [], 0, 0, True
+        while len(res) < precision:
+            r, v = (box[1], lon) if even else (box[0], lat)
+            mid = (r[0] + r[1]) / 2.0
+            ch = ch << 1 | int(v >= mid)
+            r[int(v < mid)] = mid
+            even = not even
+            bits += 1
+            if bits == 5:
+                res.append(cls.BASE32[ch])
+                ch, bits = 0, 0
+        return ''.join(res)
+
+def fleetbox(conv):
+    lats = [i.Latitude for i in conv.waypoints + conv.pois]
+    lons = [i.Longitude for i in conv.waypoints + conv.pois]
+    return min(lats), min(lons), max(lats), max(lons)
+
+def fleetindex(missions, index, maxcell=32):
+    # missions are (name, kml file, (south, west, north, east), waypoint path) tuples,
+    # crowded geohash cells are split into NetworkLinked documents with their own Region
+    cells = os.path.splitext(os.path.abspath(index))[0] + '_cells'
+    os.makedirs(cells, exist_ok=True)
+    union = lambda ms: (min([m[2][0] for m in ms]), min([m[2][1] for m in ms]), max([m[2][2] for m in ms]), max([m[2][3] for m in ms]))
+    center = lambda m: ((m[2][0] + m[2][2]) / 2.0, (m[2][1] + m[2][3]) / 2.0)
+
+    def region(box, pixels):
+        return ('Region', [
+            ('LatLonAltBox', [('north', box[2]), ('south', box[0]), ('east', box[3]), ('west', box[1])]),
+            ('Lod', [('minLodPixels', pixels), ('maxLodPixels', -1)]),
+            ])
+
+    def link(name, href, box, pixels):
+        return ('NetworkLink', [('name', name), region(box, pixels), ('Link', [('href', href), ('viewRefreshMode', 'onRegion')])])
+
+    def write(path, name, children):
+        pieces = itertools.chain([KMLStream.HEADER, KMLStream.open('Document', 1), KMLStream.element(('name', name), 2)],
+                [KMLStream.element(i, 2) for i in children], [KMLStream.close('Document', 1), KMLStream.FOOTER])
+        with open(path, 'wb') as f:
+            for chunk in KMLStream.chunks(pieces):
+                f.write(chunk)
+
+    def cell(prefix, ms, path, name):
+        here = os.path.dirname(path)
+        groups = {}
+        if len(ms) > maxcell:
+            while len(groups) < 2 and len(prefix) < 12:
+                prefix = prefix + '0'
+                groups = collections.defaultdict(list)
+                for m in ms:
+                    groups[GeoHash.encode(center(m)[0], center(m)[1], len(prefix))].append(m)
+        if len(groups) > 1:
+            children = []
+            for h, sub in sorted(groups.items()):
+                sub_path = os.path.join(cells, h + '.kml')
+                cell(h, sub, sub_path, h)
+                children.append(link(h, os.path.relpath(sub_path, here), union(sub), 128))
+        else:
+            children = [('Folder', [
+                ('name', m[0]),
+                ('Placemark', [('name', m[0]), ('LineString', [('tessellate', 1), ('coordinates', m[3])])]),
+                link('Virtual Mission', os.path.relpath(m[1], here), m[2], 256),
+                ]) for m in ms]
+        write(path, name, children)
+
+    cell('', missions, os.path.abspath(index), os.path.splitext(os.path.basename(index))[0])
+
+def batch(files, factory, elevation, outdir=None, ext='.kml', jobs=None, fleet=None):
+    files = list(collections.OrderedDict.fromkeys(files))
+    convs, failed = collections.OrderedDict(), {}
+    t = time.time()
+    for cname in files:
+        conv = factory()
+        try:
+            with open(cname) as f:
+                conv.parsecsv(f, os.path.basename(cname).rsplit('.', 1)[0])
+            if not conv.waypoints:
+                raise ValueError('No waypoints')
+            convs[cname] = conv
+        except Exception as e:
+            failed[cname] = e
+    # one elevation lookup for all missions, shared coordinates are asked once
+    unique = collections.OrderedDict()
+    for conv in convs.values():
+        for i in conv.latlons():
+            unique.setdefault(i[:2], len(unique))
+    try:
+        elevations = elevation.request(list(unique.keys()))
+    except ElevationError:
+        # a missing DEM tile only fails the missions that need it, they are found one by one
+        elevations = None
+    for cname, conv in list(convs.items()):
+        try:
+            grounds = elevation.request(conv.latlons()) if elevations is None else [elevations[unique[i[:2]]] for i in conv.latlons()]
+        except ElevationError as e:
+            failed[cname] = e
+            del convs[cname]
+            continue
+        conv.elevate(grounds)
+        conv.elevation = conv.elevcache = conv.metrics = None
+    print('Parsed {0} missions, {1} unique elevation points in {2:.2f}s'.format(len(convs), len(unique), time.time() - t))
+
+    boxes = dict([(cname, (fleetbox(conv), ' '.join(['%f,%f' % (i.Longitude, i.Latitude) for i in conv.waypoints]))) for cname, conv in convs.items()]) if fleet else {}
+    done = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures, outputs = {}, {}
+        for cname, conv in convs.items():
+            kname = cname.rsplit('.', 1)[0] + ext
+            if outdir:
+                kname = os.path.join(outdir, os.path.basename(kname))
+            # missions of the same name from different directories would overwrite each other in outdir
+            other = outputs.setdefault(os.path.normcase(os.path.abspath(kname)), cname)
+            if other != cname:
+                failed[cname] = ValueError('{0} is already written from {1}'.format(kname, other))
+                continue
+            futures[pool.submit(batchworker, conv, kname)] = (cname, kname)
+        for future in concurrent.futures.as_completed(futures):
+            cname, kname = futures[future]
+            try:
+                print('OK   {0} -> {1} ({2:.2f}s)'.format(cname, kname, future.result()))
+                done.append((cname, kname))
+            except Exception as e:
+                failed[cname] = e
+    if fleet and done:
+        fleetindex([(convs[c].mission, k) + boxes[c] for c, k in sorted(done)], fleet)
+        print('Fleet index {0} for {1} missions'.format(fleet, len(done)))
+    for cname, e in failed.items():
+        print('FAIL {0}: {1}'.format(cname, e))
+    print('Converted {0} of {1} missions in {2:.2f}s'.format(len(files) - len(failed), len(files), time.time() - t))
+    return 1 if failed else 0
+
+def preload(http=True, tree=False):
+    # imports what the lazily loading stages need, e.g. before forking workers
+    if http:
+        import requests
+    if tree:
+        import pykml.factory
+        import lxml.etree
+    import zipfile
+    import sqlite3
 
 class MyHelpFormatter(argparse.HelpFormatter):
     def __init__(self, *kc, **kv):
@@ -446,24 +1822,62 @@ class MyHelpFormatter(argparse.HelpFormatter):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=MyHelpFormatter)
-    parser.add_argument('csvfile', help='litchi hub csv exported mission')
-    parser.add_argument('kmlfile', help='write virtual mission to this file', default=None, nargs='?')
+    parser.add_argument('csvfile', help='litchi hub csv exported mission or .vlmk keyframe file', nargs='?')
+    parser.add_argument('kmlfile', help='write virtual mission to this file, compressed if it ends with .kmz, keyframes if it ends with .vlmk', default=None, nargs='?')
     parser.add_argument('-s', '--speed', help='Default speed in m/s', type=float, default=10.0)
     parser.add_argument('-f', '--fov', help='FOV angle', type=float, default=85.0)
     parser.add_argument('-g', '--ground', help='Takeoff point altitude', type=float, default=None)
     parser.add_argument('-b', '--bezier', help='Number of points to fill curves with bezier interpolation', type=int, default=5)
     parser.add_argument('-i', '--interval', help='Divide interval between points if exceeds this value in meters', type=float, default=1000.0)
+    parser.add_argument('-a', '--tolerance', help='Sample curves and legs adaptively to this chord error in meters instead of fixed counts', type=float, default=None)
+    parser.add_argument('--max-turn', help='Largest heading change between adaptive curve samples in degrees', type=float, default=10.0)
+    parser.add_argument('--simplify', help='Drop path points closer than this many meters to the simplified path, numbered waypoints are kept', type=float, default=None)
+    parser.add_argument('-r', '--frame-interval', help='Resample the tour to a keyframe every this many seconds of simulated flight', type=float, default=None)
+    parser.add_argument('--accel', help='Acceleration limit in m/s2 for the simulated flight', type=float, default=2.0)
     parser.add_argument('-m', '--mincurve', help='Minimal curve radius', type=float, default=5.0)
     parser.add_argument('-k', '--googlekey', help='Google maps elevation API key', default='')
     parser.add_argument('-e', '--openelevation', help='OpenElevation API host', default='api.open-elevation.com')
+    parser.add_argument('-B', '--batch', help='Convert many missions: CSV files, directories, globs or @manifest files', nargs='+', default=None)
+    parser.add_argument('-o', '--outdir', help='Output directory for batch mode', default=None)
+    parser.add_argument('-j', '--jobs', help='Number of batch mode worker processes', type=int, default=None)
+    parser.add_argument('-F', '--fleet', help='Batch mode: also write this overview KML linking all missions by region', default=None)
+    parser.add_argument('-z', '--kmz', help='Write compressed KMZ when no output file is given', action='store_true')
     parser.add_argument('-t', '--tnw', help='Toward Next Waypoint mode', action='store_true')
+    parser.add_argument('-d', '--dem', help='Directory with SRTM .hgt tiles to use instead of elevation API', default=None)
+    parser.add_argument('-w', '--workers', help='Number of concurrent elevation API requests', type=int, default=4)
+    parser.add_argument('--retries', help='Elevation API request retries', type=int, default=3)
+    parser.add_argument('--rate', help='Elevation API requests per second limit, 0 for unlimited', type=float, default=None)
+    parser.add_argument('--fast-geo', help='Use local tangent plane approximation for legs shorter than 1 km', action='store_true')
+    parser.add_argument('-p', '--profile', help='Print per stage timings and counters', action='store_true')
+    parser.add_argument('-c', '--cache', help='Persistent elevation cache file (sqlite)', default=None)
+    parser.add_argument('--cache-grid', help='Elevation cache grid resolution in degrees', type=float, default=0.00001)
+    parser.add_argument('--cache-ttl', help='Elevation cache entry lifetime in seconds, 0 for unlimited', type=float, default=0)
+    parser.add_argument('--cache-size', help='Maximal number of elevation cache entries', type=int, default=1000000)
     args = parser.parse_args()
 
-    if not args.kmlfile:
-        args.kmlfile = args.csvfile.rsplit('.', 1)[0]+'.kml'
+    if not args.csvfile and not args.batch:
+        parser.error('csvfile or --batch is required')
+    if args.fleet and not args.batch:
+        parser.error('--fleet needs --batch')
+    if args.accel <= 0:
+        parser.error('--accel must be positive')
+    if args.frame_interval is not None and args.frame_interval <= 0:
+        parser.error('--frame-interval must be positive')
+    if args.csvfile and not args.kmlfile:
+        args.kmlfile = args.csvfile.rsplit('.', 1)[0]+['.kml', '.kmz'][int(args.kmz)]
 
     logging.basicConfig()
 
-    c = Convert(googlekey=args.googlekey, openapiurl='https://{0}/api/v1/lookup'.format(args.openelevation), speed=args.speed, fov=args.fov, takeoffalt=args.ground, mincurve=args.mincurve, nbezier=args.bezier, infilldist=args.interval, headingmode=[3, 0][int(args.tnw)])
-    c.run(args.csvfile, args.kmlfile)
+    metrics = Metrics() if args.profile else None
+    elevcache = ElevationCache(path=args.cache, grid=args.cache_grid, ttl=args.cache_ttl, maxsize=args.cache_size) if args.cache else None
+    openapiurl = 'https://{0}/api/v1/lookup'.format(args.openelevation)
+    elevation = Elevation(key=args.googlekey, openapi=openapiurl, cache=elevcache, workers=args.workers, retries=args.retries, rate=args.rate, dem=DemTiles(args.dem) if args.dem else None, metrics=metrics)
+    factory = functools.partial(Convert, googlekey=args.googlekey, openapiurl=openapiurl, speed=args.speed, fov=args.fov, takeoffalt=args.ground, mincurve=args.mincurve, nbezier=args.bezier, infilldist=args.interval, headingmode=[3, 0][int(args.tnw)], elevcache=elevcache, elevation=elevation, fastgeo=args.fast_geo, metrics=metrics, tolerance=args.tolerance, maxturn=args.max_turn, simplify=args.simplify, frameinterval=args.frame_interval, accel=args.accel)
+    if args.batch:
+        status = batch(batchfiles(args.batch + ([args.csvfile] if args.csvfile else [])), factory, elevation, outdir=args.outdir, ext=['.kml', '.kmz'][int(args.kmz)], jobs=args.jobs, fleet=args.fleet)
+    else:
+        status = factory().run(args.csvfile, args.kmlfile)
+    if metrics:
+        sys.stderr.write(metrics.report())
+    sys.exit(status)
 
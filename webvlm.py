@@ -4,6 +4,10 @@ from flask import Flask
 from flask import request
 import json
 import os
+import time
+import zlib
+import hashlib
+import tempfile
 import vlm
 
 DRONES = {
@@ -18,17 +22,128 @@ DRONES = {
   'p42': {'fov': 84.0, },
 }
 
+KMLTYPE = 'application/vnd.google-earth.kml+xml'
+KMZTYPE = 'application/vnd.google-earth.kmz'
+FORMATS = { 'application/json': 'json', KMLTYPE: 'kml', KMZTYPE: 'kmz' }
+
 app = Flask(__name__)
 #app.config['PROPAGATE_EXCEPTIONS'] = True
+# request bodies over this are refused before they are read, missions over these limits while they are parsed and smoothed
+maxbody = int(os.getenv('MAXBODY', str(16*1024*1024)))
+maxwaypoints = int(os.getenv('MAXWAYPOINTS', '10000'))
+maxsmoothed = int(os.getenv('MAXSMOOTHED', '100000'))
+app.config['MAX_CONTENT_LENGTH'] = maxbody or None
 
 googlekey = os.getenv('GOOGLEKEY', '')
 openapiurl = os.getenv('OPENAPIURL', '')
+elevcache = vlm.ElevationCache(path=os.getenv('ELEVCACHE') or None, grid=float(os.getenv('ELEVCACHEGRID', '0.00001')), ttl=float(os.getenv('ELEVCACHETTL', '0')), maxsize=int(os.getenv('ELEVCACHESIZE', '1000000')))
 
-@app.route('/convert', methods=['POST'])
-def api():
-    j = request.get_json()
-    if not j or not '0' in j.keys() or not '1' in j.keys():
-        return 'Bad request\n', 400, {'Content-Type': 'text/plain; charset=utf-8'}
+demdir = os.getenv('DEMDIR', '')
+demtiles = vlm.DemTiles(demdir, maxtiles=int(os.getenv('DEMTILES', '16'))) if demdir else None
+fastgeo = bool(os.getenv('FASTGEO', ''))
+elevworkers = int(os.getenv('ELEVWORKERS', '4'))
+elevrate = float(os.getenv('ELEVRATE')) if os.getenv('ELEVRATE') else None
+metrics = vlm.Metrics()
+elevbatch = float(os.getenv('ELEVBATCH', '0'))
+elevbatcher = vlm.ElevationBatcher(vlm.Elevation(key=googlekey, openapi=openapiurl, workers=elevworkers, rate=elevrate), window=elevbatch, metrics=metrics) if elevbatch and not demtiles else None
+
+class ResultCache(object):
+    # size is a running estimate per process, the directory is only rescanned
+    # when it passes maxbytes or every RESCAN stores, to see other processes' entries
+    RESCAN = 100
+    LOWWATER = 0.9
+
+    def __init__(self, path, maxbytes=256*1024*1024):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        os.makedirs(path, exist_ok=True)
+        self.evict()
+
+    @staticmethod
+    def key(*params):
+        return hashlib.sha256(json.dumps(params).encode('utf-8')).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.kml.gz')
+
+    def get(self, key):
+        # entries are gzipped KML, mtime is bumped on every hit for LRU eviction
+        try:
+            with open(self.filename(key), 'rb') as f:
+                data = f.read()
+            os.utime(self.filename(key), None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def store(self, key, chunks):
+        # passes chunks through, the entry only appears if the stream completes
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        z = zlib.compressobj(6, zlib.DEFLATED, 31)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(z.compress(chunk))
+                    yield chunk
+                f.write(z.flush())
+            size = os.path.getsize(tmp)
+            os.replace(tmp, self.filename(key))
+            tmp = None
+        finally:
+            if tmp:
+                os.unlink(tmp)
+        self.count += 1
+        self.bytes += size
+        self.stores += 1
+        if self.bytes > self.maxbytes or self.stores % self.RESCAN == 0:
+            self.evict()
+
+    def entries(self):
+        res = []
+        for name in os.listdir(self.path):
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            if name.endswith('.kml.gz'):
+                res.append((st.st_mtime, st.st_size, name))
+        return res
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum([i[1] for i in entries])
+        count = len(entries)
+        # once over maxbytes, evict down to LOWWATER so the next stores don't rescan
+        limit = self.maxbytes * self.LOWWATER if total > self.maxbytes else self.maxbytes
+        for mtime, size, name in entries:
+            if total <= limit:
+                break
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+            count -= 1
+        self.count = count
+        self.bytes = total
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': self.count, 'bytes': self.bytes}
+
+def compress(chunks, wbits):
+    z = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        c = z.compress(chunk)
+        if c:
+            yield c
+    yield z.flush()
+
+def params(j):
     try:
         defspeed = float(j['horizontalSpeed'])
     except (KeyError, ValueError):
@@ -51,21 +166,157 @@ def api():
         headingmode = int(j['headingMode'])
     except (KeyError, ValueError):
         headingmode = 3
-    conv = vlm.Convert(googlekey=googlekey, openapiurl=openapiurl, speed=defspeed, infilldist=infilldist, fov=fov, headingmode=headingmode)
+    return j['1'].rsplit('.', 1)[0], defspeed, infilldist, fov, headingmode
+
+def resultkey(csv, *params):
+    return ResultCache.key(csv, *params, demdir, bool(googlekey), openapiurl, fastgeo)
+
+def newconvert(defspeed, infilldist, fov, headingmode):
+    elevation = vlm.Elevation(key=googlekey, openapi=openapiurl, cache=elevcache, workers=elevworkers, rate=elevrate, dem=demtiles, metrics=metrics, batcher=elevbatcher)
+    return vlm.Convert(googlekey=googlekey, openapiurl=openapiurl, speed=defspeed, infilldist=infilldist, fov=fov, headingmode=headingmode, elevcache=elevcache, elevation=elevation, fastgeo=fastgeo, metrics=metrics, maxwaypoints=maxwaypoints or None, maxsmoothed=maxsmoothed or None)
+
+def jsonbody(kml, mission):
+    spent = 0.0
+    yield b'{"kml": "'
+    for chunk in kml:
+        t = time.time()
+        chunk = json.dumps(chunk.decode('utf-8'))[1:-1].encode('utf-8')
+        spent += time.time() - t
+        yield chunk
+    metrics.observe('vlm_stage_seconds', spent, stage='json')
+    yield ('", "mission": ' + json.dumps(mission) + '}').encode('utf-8')
+
+resultcache = ResultCache(os.getenv('RESULTCACHE'), maxbytes=int(os.getenv('RESULTCACHESIZE', str(256*1024*1024)))) if os.getenv('RESULTCACHE') else None
+
+def postfork():
+    # per process handles, opened in every worker right after fork instead of on its first request
+    elevcache.connect()
+    if not demtiles:
+        vlm.Elevation.session()
+
+# the uwsgi master imports this module once, workers forked from it share what is loaded here
+vlm.preload(http=not demtiles)
+try:
+    import uwsgidecorators
+    uwsgidecorators.postfork(postfork)
+except ImportError:
+    pass
+
+def oversized(csv):
+    # a line count bounds the waypoints without parsing anything
+    return bool(maxwaypoints) and isinstance(csv, str) and csv.count('\n') > maxwaypoints + 1
+
+def failure(status, message, fmt=None):
+    if fmt:
+        metrics.inc('vlm_requests_total', status=status, format=FORMATS[fmt])
+    return status, {'Content-Type': 'text/plain; charset=utf-8'}, [message.encode('utf-8')]
+
+def negotiate(j, accept, etags):
+    # the part of /convert shared by the Flask and ASGI front ends that runs before converting,
+    # returns a finished (status, headers, body) response or the request state for respond()
+    if not isinstance(j, dict) or not '0' in j.keys() or not '1' in j.keys():
+        return failure(400, 'Bad request\n'), None
+    # old clients get JSON, raw KML/KMZ has to be asked for in Accept
+    fmt = accept.best_match(list(FORMATS.keys()), default='application/json')
     try:
-        mission = j['1'].rsplit('.', 1)[0]
-        csv = j['0'].split('\n')
-        conv.readcsv(csv, mission)
-    except:
-        return 'Bad request data\n', 400, {'Content-Type': 'text/plain; charset=utf-8'}
-    conv.smooth()
-    kml = conv.getkml()
-    resp = json.dumps({'kml':kml.decode('utf-8'), 'mission':mission})
-    return resp, 200, {'Content-Type': 'application/json; charset=utf-8'}
+        p = params(j)
+    except AttributeError:
+        return failure(400, 'Bad request data\n'), None
+    if oversized(j['0']):
+        return failure(413, 'Mission too large\n', fmt), None
+    key = resultkey(j['0'], *p)
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    cached = None
+    if resultcache:
+        headers['ETag'] = '"{0}-{1}"'.format(key, FORMATS[fmt])
+        cached = resultcache.get(key)
+        if cached is not None and etags.contains(headers['ETag'][1:-1]):
+            metrics.inc('vlm_requests_total', status=304, format=FORMATS[fmt])
+            return (304, headers, []), None
+    return None, (fmt, p, key, headers, cached)
+
+def respond(state, kml, encodings):
+    # kml is ignored when the result came from the cache
+    fmt, p, key, headers, cached = state
+    mission = p[0]
+    if cached is not None:
+        kml = [zlib.decompress(cached, 31)]
+    metrics.inc('vlm_requests_total', status=200, format=FORMATS[fmt])
+    metrics.inc('vlm_result_cache_total', result='hit' if cached is not None else 'miss')
+    if fmt == KMZTYPE:
+        headers['Content-Type'] = KMZTYPE
+        headers['Content-Disposition'] = 'attachment; filename="{0}.kmz"'.format(mission.replace('"', ''))
+        return 200, headers, vlm.KMLStream.kmz(kml)
+    if fmt == KMLTYPE:
+        headers['Content-Type'] = KMLTYPE + '; charset=utf-8'
+        headers['Content-Disposition'] = 'attachment; filename="{0}.kml"'.format(mission.replace('"', ''))
+        if cached is not None and encodings['gzip']:
+            headers['Content-Encoding'] = 'gzip'
+            return 200, headers, [cached]
+        body = kml
+    else:
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        body = jsonbody(kml, mission)
+    if encodings['gzip']:
+        headers['Content-Encoding'] = 'gzip'
+        body = compress(body, 31)
+    elif encodings['deflate']:
+        headers['Content-Encoding'] = 'deflate'
+        body = compress(body, 15)
+    return 200, headers, body
+
+def convert(j, state, encodings):
+    fmt, p, key, headers, cached = state
+    kml = None
+    if cached is None:
+        conv = newconvert(*p[1:])
+        try:
+            conv.readcsv(j.pop('0'), p[0])
+        except vlm.LimitError:
+            return failure(413, 'Mission too large\n', fmt)
+        except vlm.ElevationError:
+            # a missing DEM tile is the server's problem, not the client's
+            return failure(503, 'Elevation unavailable\n', fmt)
+        except:
+            return failure(400, 'Bad request data\n', fmt)
+        try:
+            conv.smooth()
+        except vlm.LimitError:
+            return failure(413, 'Mission too large\n', fmt)
+        kml = conv.iterkml()
+        # results built on the zero elevation fallback are not worth keeping
+        if resultcache and not conv.elevation.errors:
+            kml = resultcache.store(key, kml)
+    return respond(state, kml, encodings)
+
+@app.route('/convert', methods=['POST'])
+def api():
+    # not cached on the request, so the body and the CSV string can go once they are parsed
+    j = request.get_json(cache=False)
+    resp, state = negotiate(j, request.accept_mimetypes, request.if_none_match)
+    if resp is None:
+        resp = convert(j, state, request.accept_encodings)
+    status, headers, body = resp
+    return app.response_class(body, status, headers)
 
 @app.route('/healthz')
 def healthz():
-    return 'HEALTH_OK\nUsing ' + ['Google', 'Open'][int(googlekey=='')] + ' elevation API\n', 200, {'Content-Type': 'application/json; charset=utf-8'}
+    provider = 'local DEM' if demdir else ['Google', 'Open'][int(googlekey=='')] + ' elevation API'
+    resp = 'HEALTH_OK\nUsing ' + provider + '\nElevation cache: {hits} hits, {misses} misses\n'.format(**elevcache.stats())
+    if resultcache:
+        resp += 'Result cache: {hits} hits, {misses} misses, {entries} entries, {bytes} bytes\n'.format(**resultcache.stats())
+    return resp, 200, {'Content-Type': 'application/json; charset=utf-8'}
+
+@app.route('/metrics')
+def prometheus():
+    resp = metrics.prometheus()
+    gauges = [('vlm_elevation_cache', elevcache.stats())]
+    if resultcache:
+        gauges.append(('vlm_result_cache', resultcache.stats()))
+    for prefix, stats in gauges:
+        for k, v in sorted(stats.items()):
+            resp += '# TYPE {0}_{1} gauge\n{0}_{1} {2}\n'.format(prefix, k, v)
+    return resp, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 if __name__ == '__main__':
     app.run()